@@ -0,0 +1,533 @@
+"""Offline benchmarks for the stack rename. No AWS credentials or network access are used.
+
+    python3 benchmark.py [--api-latency 0.002] [--operation-time 0.2] [--page-size 100] [--nested-depth 4] [--template-mb 10]
+
+The full-rename benchmark drives StackRenamer against FakeCloudFormation, an in-memory backend with
+configurable latency and pagination, and reports API calls, request bytes, wall time and time spent
+sleeping in each phase.
+"""
+import argparse
+import copy
+import json
+import time
+import timeit
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+from index import IntrinsicResolver, StackRenamer, TemplateStager, WaitEngine, describeNestedStacks, diffTemplates, walkNestedStacks
+
+def syntheticStack(resource_count):
+    template = {
+        'Resources': {}
+    }
+    deployed_resources = []
+    resource_drifts = []
+    for i in range(resource_count):
+        logical_id = 'Queue' + str(i)
+        template['Resources'][logical_id] = {
+            'Type': 'AWS::SQS::Queue',
+            'Properties': {
+                'QueueName': 'queue-' + str(i)
+            }
+        }
+        deployed_resources.append({
+            'LogicalResourceId': logical_id,
+            'ResourceType': 'AWS::SQS::Queue'
+        })
+        resource_drifts.append({
+            'LogicalResourceId': logical_id,
+            'ResourceType': 'AWS::SQS::Queue',
+            'PhysicalResourceId': 'https://sqs.us-east-1.amazonaws.com/123456789012/queue-' + str(i),
+            'ActualProperties': json.dumps(template['Resources'][logical_id]['Properties'])
+        })
+    return template, deployed_resources, resource_drifts
+
+def nestedScanValidate(template, original_resources, resource_drifts):
+    # the pre-index validation loop, kept as the baseline to compare against
+    for k, v in template['Resources'].items():
+        found = False
+        resource_exists = False
+
+        for deployed_resource in original_resources:
+            if k == deployed_resource['LogicalResourceId']:
+                resource_exists = True
+
+        if not resource_exists and 'Condition' in template['Resources'][k]:
+            continue
+
+        for i in range(len(resource_drifts)):
+            if resource_drifts[i]['LogicalResourceId'] == k:
+                found = True
+                break
+        if not found:
+            raise Exception("missing drift")
+
+def indexedValidate(template, original_resources, resource_drifts):
+    # StackRenamer's own validation, after indexing the drift records as detectDrift does; the
+    # indexing is timed too, as the rename pays for it. Returns the seconds taken.
+    renamer = StackRenamer(None, 'Benchmark', 'BenchmarkRenamed', log=lambda message: None)
+    renamer.template = template
+    renamer.original_resource_pages = iter(original_resources)
+    started = time.perf_counter()
+    renamer.indexResourceDrifts(resource_drifts)
+    renamer.validate()
+    return time.perf_counter() - started
+
+def benchmarkValidation(resource_count=500, repeat=5):
+    template, deployed_resources, resource_drifts = syntheticStack(resource_count)
+    for i, v in enumerate(template['Resources'].values()):
+        if i % 2:
+            v['Condition'] = 'Enabled' # so the deployed resource lookups are timed too
+    nested = min(timeit.repeat(lambda: nestedScanValidate(template, deployed_resources, resource_drifts), number=1, repeat=repeat))
+    indexedValidate(template, deployed_resources, resource_drifts) # loads the importable type table, once per process in a rename
+    indexed = min(indexedValidate(template, deployed_resources, resource_drifts) for i in range(repeat))
+    print("Validation of {} resources: nested scan {:.2f}ms, StackRenamer.validate {:.2f}ms ({:.1f}x)".format(
+        resource_count,
+        nested * 1000,
+        indexed * 1000,
+        nested / indexed
+    ))
+
+def syntheticLargeTemplate(target_bytes):
+    # roles with long policy documents full of references, the bulk of most large templates
+    template = {
+        'Parameters': {
+            'Env': {
+                'Type': 'String'
+            }
+        },
+        'Resources': {}
+    }
+    refs = {
+        'Env': 'prod',
+        'AWS::Region': 'us-east-1',
+        'AWS::AccountId': '123456789012'
+    }
+    size = 0
+    i = 0
+    while size < target_bytes:
+        logical_id = 'Role' + str(i)
+        refs[logical_id] = 'role-' + str(i)
+        template['Resources'][logical_id] = {
+            'Type': 'AWS::IAM::Role',
+            'Properties': {
+                'RoleName': {'Fn::Sub': '${Env}-role-' + str(i)},
+                'Policies': [{
+                    'PolicyName': 'policy',
+                    'PolicyDocument': {
+                        'Statement': [{
+                            'Effect': 'Allow',
+                            'Action': ['sqs:SendMessage', 'sqs:ReceiveMessage'],
+                            'Resource': {'Fn::Join': [':', ['arn:aws:sqs', {'Ref': 'AWS::Region'}, {'Ref': 'AWS::AccountId'}, 'queue-' + str(j)]]},
+                            'Condition': {'StringEquals': {'aws:PrincipalTag/env': {'Ref': 'Env'}}}
+                        } for j in range(20)]
+                    }
+                }]
+            }
+        }
+        size += len(json.dumps(template['Resources'][logical_id]))
+        i += 1
+    return template, refs
+
+def deepPropertyTree(depth):
+    # a Step Functions style definition nested far past the recursion limit
+    node = root = {}
+    for i in range(depth):
+        node['Next'] = {'Ref': 'Env'} if i % 2 else {}
+        node['States'] = {}
+        node = node['States']
+    return root
+
+def recursiveResolve(prop, refs):
+    # the pre-walker shape of the resolver, copying every container, kept as the baseline to compare against
+    if isinstance(prop, dict):
+        if 'Ref' in prop and prop['Ref'] in refs:
+            return refs[prop['Ref']]
+        return {k: recursiveResolve(v, refs) for k, v in prop.items()}
+    elif isinstance(prop, list):
+        return [recursiveResolve(listitem, refs) for listitem in prop]
+    return prop
+
+def benchmarkTemplateWalk(target_mb=10, deep_depth=5000):
+    template, refs = syntheticLargeTemplate(target_mb * 1024 * 1024)
+    template_bytes = len(json.dumps(template))
+    copied_template = copy.deepcopy(template)
+    unresolvable = {k: v for k, v in template.items() if k != 'Parameters'}
+    print("Template walk over {:.1f}MB, {} resources:".format(template_bytes / 1024 / 1024, len(template['Resources'])))
+
+    started = time.time()
+    recursiveResolve(template, refs)
+    print("  recursive resolve, copying       {:>8.2f}s".format(time.time() - started))
+    started = time.time()
+    IntrinsicResolver(refs).resolvePropertyValue(template)
+    print("  walker resolve                   {:>8.2f}s".format(time.time() - started))
+    started = time.time()
+    unchanged = IntrinsicResolver({}).resolvePropertyValue(unresolvable) is unresolvable
+    print("  walker resolve, nothing resolves {:>8.2f}s (original returned: {})".format(time.time() - started, unchanged))
+    started = time.time()
+    diffTemplates(template, copied_template)
+    print("  diff against a copy              {:>8.2f}s".format(time.time() - started))
+
+    deep_tree = deepPropertyTree(deep_depth)
+    try:
+        recursiveResolve(deep_tree, refs)
+        recursive_result = 'ok'
+    except RecursionError:
+        recursive_result = 'RecursionError'
+    started = time.time()
+    IntrinsicResolver(refs).resolvePropertyValue(deep_tree)
+    print("  {} levels deep: recursive {}, walker {:.2f}s".format(deep_depth, recursive_result, time.time() - started))
+
+class FakeCloudFormation:
+    """In-memory stand-in for the CloudFormation client calls the rename makes.
+
+    Every call sleeps for api_latency seconds; stack operations and drift detection settle after
+    operation_time seconds (drift detection also scales with the resource count). Drift results are
+    returned at most page_size per page. Exports come from the stacks' Outputs; imports of them are
+    listed in imports by export name.
+    """
+
+    def __init__(self, api_latency=0.002, operation_time=0.2, drift_time_per_resource=0.0005, page_size=100, s3=None):
+        self.api_latency = api_latency
+        self.s3 = s3
+        self.operation_time = operation_time
+        self.drift_time_per_resource = drift_time_per_resource
+        self.page_size = page_size
+        self.stacks = {}
+        self.change_sets = {}
+        self.drift_detections = {}
+        self.imports = {}
+
+    def addStack(self, stack_name, template, resource_drifts):
+        stack_id = 'arn:aws:cloudformation:us-east-1:123456789012:stack/' + stack_name + '/' + str(len(self.stacks))
+        self.stacks[stack_id] = {
+            'StackId': stack_id,
+            'StackName': stack_name,
+            'Template': json.dumps(template),
+            'ResourceDrifts': resource_drifts,
+            'Status': 'CREATE_COMPLETE',
+            'CreationTime': datetime.now(timezone.utc),
+            'LastCheckTimestamp': None,
+            'PendingStatus': None,
+            'SettlesAt': 0
+        }
+        return stack_id
+
+    def _call(self, operation, kwargs):
+        time.sleep(self.api_latency)
+
+    def _error(self, operation, message):
+        return ClientError({'Error': {'Code': 'ValidationError', 'Message': message}}, operation)
+
+    def _templateBody(self, kwargs):
+        if 'TemplateURL' in kwargs:
+            return self.s3.objects[kwargs['TemplateURL'].split('/', 3)[3]].decode('utf-8')
+        if len(kwargs['TemplateBody'].encode('utf-8')) > 51200:
+            raise self._error('ValidateTemplate', 'Member must have length less than or equal to 51200')
+        return kwargs['TemplateBody']
+
+    def _findStack(self, operation, stack_name):
+        if stack_name in self.stacks:
+            return self.stacks[stack_name]
+        for stack in self.stacks.values():
+            if stack['StackName'] == stack_name and stack['Status'] != 'DELETE_COMPLETE':
+                return stack
+        raise self._error(operation, 'Stack with id ' + stack_name + ' does not exist')
+
+    def _settle(self, stack):
+        if stack['PendingStatus'] and time.time() >= stack['SettlesAt']:
+            stack['Status'] = stack['PendingStatus']
+            stack['PendingStatus'] = None
+
+    def _transition(self, stack, in_progress_status, final_status):
+        stack['Status'] = in_progress_status
+        stack['PendingStatus'] = final_status
+        stack['SettlesAt'] = time.time() + self.operation_time
+
+    def describe_stacks(self, **kwargs):
+        self._call('DescribeStacks', kwargs)
+        stack = self._findStack('DescribeStacks', kwargs['StackName'])
+        self._settle(stack)
+        description = {
+            'StackId': stack['StackId'],
+            'StackName': stack['StackName'],
+            'StackStatus': stack['Status'],
+            'CreationTime': stack['CreationTime'],
+            'DriftInformation': {
+                'StackDriftStatus': 'IN_SYNC' if stack['LastCheckTimestamp'] else 'NOT_CHECKED'
+            }
+        }
+        if stack['LastCheckTimestamp']:
+            description['DriftInformation']['LastCheckTimestamp'] = stack['LastCheckTimestamp']
+        if 'LastUpdatedTime' in stack:
+            description['LastUpdatedTime'] = stack['LastUpdatedTime']
+        return {
+            'Stacks': [description]
+        }
+
+    def get_template(self, **kwargs):
+        self._call('GetTemplate', kwargs)
+        return {
+            'TemplateBody': self._findStack('GetTemplate', kwargs['StackName'])['Template']
+        }
+
+    def list_stack_resources(self, **kwargs):
+        self._call('ListStackResources', kwargs)
+        stack = self._findStack('ListStackResources', kwargs['StackName'])
+        start = int(kwargs.get('NextToken', 0))
+        end = start + self.page_size
+        result = {
+            'StackResourceSummaries': [{
+                'LogicalResourceId': resource_drift['LogicalResourceId'],
+                'PhysicalResourceId': resource_drift['PhysicalResourceId'],
+                'ResourceType': resource_drift['ResourceType']
+            } for resource_drift in stack['ResourceDrifts'][start:end]]
+        }
+        if end < len(stack['ResourceDrifts']):
+            result['NextToken'] = str(end)
+        return result
+
+    def list_exports(self, **kwargs):
+        self._call('ListExports', kwargs)
+        exports = []
+        for stack in self.stacks.values():
+            if stack['Status'] == 'DELETE_COMPLETE':
+                continue
+            for output in json.loads(stack['Template']).get('Outputs', {}).values():
+                if isinstance(output.get('Export', {}).get('Name'), str):
+                    exports.append({
+                        'ExportingStackId': stack['StackId'],
+                        'Name': output['Export']['Name'],
+                        'Value': output['Value']
+                    })
+        start = int(kwargs.get('NextToken', 0))
+        end = start + self.page_size
+        result = {
+            'Exports': exports[start:end]
+        }
+        if end < len(exports):
+            result['NextToken'] = str(end)
+        return result
+
+    def list_imports(self, **kwargs):
+        self._call('ListImports', kwargs)
+        if not self.imports.get(kwargs['ExportName']):
+            raise self._error('ListImports', 'Export \'' + kwargs['ExportName'] + '\' is not imported by any stack.')
+        return {
+            'Imports': self.imports[kwargs['ExportName']]
+        }
+
+    def detect_stack_drift(self, **kwargs):
+        self._call('DetectStackDrift', kwargs)
+        stack = self._findStack('DetectStackDrift', kwargs['StackName'])
+        detection_id = str(len(self.drift_detections))
+        self.drift_detections[detection_id] = (stack, time.time() + self.operation_time + self.drift_time_per_resource * len(stack['ResourceDrifts']))
+        return {
+            'StackDriftDetectionId': detection_id
+        }
+
+    def describe_stack_drift_detection_status(self, **kwargs):
+        self._call('DescribeStackDriftDetectionStatus', kwargs)
+        stack, completes_at = self.drift_detections[kwargs['StackDriftDetectionId']]
+        if time.time() < completes_at:
+            return {
+                'DetectionStatus': 'DETECTION_IN_PROGRESS'
+            }
+        if stack['LastCheckTimestamp'] is None or stack['LastCheckTimestamp'].timestamp() < completes_at:
+            stack['LastCheckTimestamp'] = datetime.fromtimestamp(completes_at, timezone.utc)
+        return {
+            'DetectionStatus': 'DETECTION_COMPLETE',
+            'StackDriftStatus': 'IN_SYNC',
+            'Timestamp': stack['LastCheckTimestamp']
+        }
+
+    def describe_stack_resource_drifts(self, **kwargs):
+        self._call('DescribeStackResourceDrifts', kwargs)
+        stack = self._findStack('DescribeStackResourceDrifts', kwargs['StackName'])
+        status_filters = kwargs.get('StackResourceDriftStatusFilters', ['IN_SYNC', 'MODIFIED', 'DELETED', 'NOT_CHECKED'])
+        resource_drifts = [resource_drift for resource_drift in stack['ResourceDrifts'] if resource_drift.get('StackResourceDriftStatus', 'IN_SYNC') in status_filters]
+        start = int(kwargs.get('NextToken', 0))
+        end = start + min(kwargs.get('MaxResults', 100), self.page_size)
+        result = {
+            'StackResourceDrifts': resource_drifts[start:end]
+        }
+        if end < len(resource_drifts):
+            result['NextToken'] = str(end)
+        return result
+
+    def update_stack(self, **kwargs):
+        self._call('UpdateStack', kwargs)
+        stack = self._findStack('UpdateStack', kwargs['StackName'])
+        stack['Template'] = self._templateBody(kwargs)
+        stack['LastUpdatedTime'] = datetime.now(timezone.utc)
+        self._transition(stack, 'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE')
+        return {
+            'StackId': stack['StackId']
+        }
+
+    def delete_stack(self, **kwargs):
+        self._call('DeleteStack', kwargs)
+        self._transition(self._findStack('DeleteStack', kwargs['StackName']), 'DELETE_IN_PROGRESS', 'DELETE_COMPLETE')
+
+    def create_change_set(self, **kwargs):
+        self._call('CreateChangeSet', kwargs)
+        stack_id = self.addStack(kwargs['StackName'], json.loads(self._templateBody(kwargs)), [])
+        stack = self.stacks[stack_id]
+        stack['Status'] = 'REVIEW_IN_PROGRESS'
+        self.change_sets[(stack_id, kwargs['ChangeSetName'])] = {
+            'ReadyAt': time.time() + self.operation_time,
+            'ResourcesToImport': kwargs['ResourcesToImport'],
+            'ExecutionStatus': 'AVAILABLE'
+        }
+        return {
+            'Id': kwargs['ChangeSetName'],
+            'StackId': stack_id
+        }
+
+    def describe_change_set(self, **kwargs):
+        self._call('DescribeChangeSet', kwargs)
+        change_set = self.change_sets[(kwargs['StackName'], kwargs['ChangeSetName'])]
+        if time.time() < change_set['ReadyAt']:
+            return {
+                'Status': 'CREATE_IN_PROGRESS',
+                'ExecutionStatus': 'UNAVAILABLE'
+            }
+        return {
+            'Status': 'CREATE_COMPLETE',
+            'ExecutionStatus': change_set['ExecutionStatus']
+        }
+
+    def execute_change_set(self, **kwargs):
+        self._call('ExecuteChangeSet', kwargs)
+        stack = self.stacks[kwargs['StackName']]
+        change_set = self.change_sets[(kwargs['StackName'], kwargs['ChangeSetName'])]
+        change_set['ExecutionStatus'] = 'EXECUTE_COMPLETE'
+        resources = json.loads(stack['Template'])['Resources']
+        stack['ResourceDrifts'] = [{
+            'LogicalResourceId': resource['LogicalResourceId'],
+            'ResourceType': resource['ResourceType'],
+            'PhysicalResourceId': list(resource['ResourceIdentifier'].values())[0],
+            'ActualProperties': json.dumps(resources[resource['LogicalResourceId']].get('Properties', {}))
+        } for resource in change_set['ResourcesToImport']]
+        self._transition(stack, 'IMPORT_IN_PROGRESS', 'IMPORT_COMPLETE')
+
+class FakeS3:
+    """In-memory stand-in for the S3 calls made when staging large templates."""
+
+    class meta:
+        region_name = 'us-east-1'
+
+    def __init__(self, api_latency=0.002):
+        self.api_latency = api_latency
+        self.objects = {}
+        self.puts = 0
+
+    def head_object(self, **kwargs):
+        time.sleep(self.api_latency)
+        if kwargs['Key'] not in self.objects:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+        return {
+            'ContentLength': len(self.objects[kwargs['Key']])
+        }
+
+    def put_object(self, **kwargs):
+        time.sleep(self.api_latency)
+        self.objects[kwargs['Key']] = kwargs['Body']
+        self.puts += 1
+        return {}
+
+def syntheticNestedStacks(cfnclient, stack_name, depth, fan_out):
+    # a parent holding fan_out nested stacks, each holding fan_out more, depth levels down
+    template, deployed_resources, resource_drifts = syntheticStack(2)
+    if depth > 0:
+        for i in range(fan_out):
+            logical_id = 'Child' + str(i)
+            child_stack_id = syntheticNestedStacks(cfnclient, stack_name + '-' + logical_id, depth - 1, fan_out)
+            template['Resources'][logical_id] = {
+                'Type': 'AWS::CloudFormation::Stack',
+                'Properties': {
+                    'TemplateURL': 'https://s3.amazonaws.com/benchmark-templates/' + logical_id + '.json'
+                }
+            }
+            resource_drifts.append({
+                'LogicalResourceId': logical_id,
+                'ResourceType': 'AWS::CloudFormation::Stack',
+                'PhysicalResourceId': child_stack_id,
+                'StackResourceDriftStatus': 'NOT_CHECKED'
+            })
+    return cfnclient.addStack(stack_name, template, resource_drifts)
+
+def benchmarkNestedDiscovery(depth, fan_out, api_latency, concurrencies=[1, 4, 16]):
+    cfnclient = FakeCloudFormation(api_latency=api_latency)
+    root_stack_id = syntheticNestedStacks(cfnclient, 'Benchmark', depth, fan_out)
+    child_stacks = {
+        resource['LogicalResourceId']: resource['PhysicalResourceId']
+        for resource in cfnclient.stacks[root_stack_id]['ResourceDrifts'] if resource['ResourceType'] == 'AWS::CloudFormation::Stack'
+    }
+    for concurrency in concurrencies:
+        started = time.time()
+        nested_stacks = describeNestedStacks(cfnclient, child_stacks, concurrency)
+        print("Nested stack tree of {} stacks, {} levels deep, concurrency {}: {:.2f}s".format(
+            len(list(walkNestedStacks(nested_stacks))),
+            depth,
+            concurrency,
+            time.time() - started
+        ))
+
+def benchmarkRename(resource_count, api_latency, operation_time, page_size, wait_options):
+    template, deployed_resources, resource_drifts = syntheticStack(resource_count)
+    s3client = FakeS3(api_latency=api_latency)
+    cfnclient = FakeCloudFormation(api_latency=api_latency, operation_time=operation_time, page_size=page_size, s3=s3client)
+    cfnclient.addStack('Benchmark', template, resource_drifts)
+
+    quiet = lambda message: None
+    wait_engine = WaitEngine(log=quiet, **wait_options)
+    template_stager = TemplateStager(s3client, 'benchmark-templates', log=quiet)
+    renamer = StackRenamer(cfnclient, 'Benchmark', 'BenchmarkRenamed', log=quiet, wait_engine=wait_engine, template_stager=template_stager)
+
+    renamer.run()
+    report = renamer.recorder.report()
+
+    print("Full rename of {} resources (api latency {:.0f}ms, operations {:.2f}s, page size {}):".format(
+        resource_count,
+        api_latency * 1000,
+        operation_time,
+        page_size
+    ))
+    print("  {:<16} {:>6} {:>12} {:>9} {:>9}".format('phase', 'calls', 'bytes sent', 'wall', 'slept'))
+    totals = [0, 0, 0.0, 0.0]
+    for phase in report['Phases']:
+        slept = sum(wait['Slept'] for wait in phase['Waits'])
+        print("  {:<16} {:>6} {:>12} {:>8.2f}s {:>8.2f}s".format(phase['Phase'], phase['Calls'], phase['BytesSent'], phase['Elapsed'], slept))
+        totals[0] += phase['Calls']
+        totals[1] += phase['BytesSent']
+        totals[2] += phase['Elapsed']
+        totals[3] += slept
+    print("  {:<16} {:>6} {:>12} {:>8.2f}s {:>8.2f}s".format('total', *totals))
+    print("  {} drift result page(s), {} bytes".format(report['DriftPages'], report['DriftBytes']))
+    print("  {} template(s) staged in S3".format(s3client.puts))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the offline stack rename benchmarks')
+    parser.add_argument('--api-latency', type=float, default=0.002, help='seconds added to every fake API call (default: 0.002)')
+    parser.add_argument('--operation-time', type=float, default=0.2, help='seconds each fake stack operation takes to settle (default: 0.2)')
+    parser.add_argument('--page-size', type=int, default=100, help='maximum drift results returned per page (default: 100)')
+    parser.add_argument('--resource-counts', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--template-mb', type=int, default=10, help='size of the synthetic template in the template walk benchmark (default: 10)')
+    parser.add_argument('--nested-depth', type=int, default=4, help='levels of nested stacks in the nested stack benchmark (default: 4)')
+    parser.add_argument('--nested-fan-out', type=int, default=3, help='nested stacks held by each stack in the nested stack benchmark (default: 3)')
+    args = parser.parse_args()
+
+    # fake operations settle in fractions of a second, so scale polling down to match
+    wait_options = {
+        'initial_delay': args.operation_time / 20,
+        'max_delay': args.operation_time / 2
+    }
+
+    for resource_count in args.resource_counts:
+        benchmarkValidation(resource_count)
+    benchmarkTemplateWalk(args.template_mb)
+    benchmarkNestedDiscovery(args.nested_depth, args.nested_fan_out, args.api_latency)
+    for resource_count in args.resource_counts:
+        benchmarkRename(resource_count, args.api_latency, args.operation_time, args.page_size, wait_options)
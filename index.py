@@ -3,1564 +3,2042 @@ import sys
 import json
 import time
 import pprint
+import os
+import argparse
+import random
+import hashlib
+import copy
+import threading
+import asyncio
+import re
 from collections import OrderedDict
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from cfn_flip import flip, to_yaml, to_json
 
-resolve_matches = {}
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
 
-def resolvePropertyValue(prop, match_resources, replace_values):
-    if isinstance(prop, dict):
-        if 'Ref' in prop:
-            if prop['Ref'] in match_resources:
-                if replace_values:
-                    return resolve_matches['Ref' + prop['Ref']]
-                else:
-                    resolve_matches['Ref' + prop['Ref']] = {
-                        'Ref': prop['Ref']
-                    }
-        elif 'Fn::GetAtt' in prop:
-            if prop['Fn::GetAtt'][0] in match_resources:
-                if replace_values:
-                    return resolve_matches['GetAtt' + prop['Fn::GetAtt'][0] + prop['Fn::GetAtt'][1]]
+ELIGIBLE_IMPORT_RESOURCES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'eligible_import_resources.json')
+eligible_import_resources = None # originally from Former2, loaded on first lookup
+eligible_import_resources_lock = threading.Lock()
+
+WALK_SKIP = object() # returned by a walkTemplate visitor to leave a node's children unvisited
+
+def walkTemplate(root, visit):
+    # depth-first over every node under root with an explicit stack, so deeply nested property trees
+    # can't hit the recursion limit. visit(path, value) is called for each node, path being the key
+    # tuple from root. Returning value visits its children, WALK_SKIP doesn't, and anything else
+    # replaces the node; containers are only copied along the paths to a replacement.
+    result = visit((), root)
+    if result is WALK_SKIP:
+        return root
+    if result is not root or not isinstance(root, (dict, list)):
+        return result
+
+    stack = [[root, iter(root.items() if isinstance(root, dict) else enumerate(root)), (), None, None]] # container, items, path, copy, key
+    while True:
+        frame = stack[-1]
+        item = next(frame[1], None)
+        if item is None:
+            stack.pop()
+            finished = frame[3] if frame[3] is not None else frame[0]
+            if not stack:
+                return finished
+            if finished is not frame[0]:
+                parent = stack[-1]
+                if parent[3] is None:
+                    parent[3] = parent[0].copy()
+                parent[3][frame[4]] = finished
+            continue
+
+        key, value = item
+        path = frame[2] + (key,)
+        result = visit(path, value)
+        if result is WALK_SKIP:
+            continue
+        if result is not value:
+            if frame[3] is None:
+                frame[3] = frame[0].copy()
+            frame[3][key] = result
+        elif isinstance(value, (dict, list)):
+            stack.append([value, iter(value.items() if isinstance(value, dict) else enumerate(value)), path, None, key])
+
+class IntrinsicResolver:
+    """Resolves Ref, Fn::GetAtt, Fn::Sub, Fn::Join and Fn::Select against known values.
+
+    Anything that can't be resolved is left as it is, and the original objects come back unchanged
+    when nothing inside them resolves, so a pass over a large template allocates only along the
+    paths it actually changes. Resolved Fn::Sub strings are memoized for the life of the resolver.
+    """
+
+    FUNCTIONS = ['Ref', 'Fn::GetAtt', 'Fn::Sub', 'Fn::Join', 'Fn::Select']
+    SUB_VARIABLE = re.compile(r'\$\{([^}]*)\}')
+    UNRESOLVED = object()
+
+    def __init__(self, refs=None, attributes=None):
+        self.refs = refs if refs is not None else {} # by logical ID or parameter name
+        self.attributes = attributes if attributes is not None else {} # by (logical ID, attribute name)
+        self.memo = {}
+
+    def resolvePropertyValue(self, prop):
+        return walkTemplate(prop, self.visitIntrinsic)
+
+    def visitIntrinsic(self, path, value):
+        if isinstance(value, dict) and len(value) == 1:
+            function, args = next(iter(value.items()))
+            if function == 'Ref' and isinstance(args, str):
+                return self.resolveRef(args, value)
+            if function == 'Fn::GetAtt':
+                return self.resolveGetAtt(args, value)
+            if function == 'Fn::Sub':
+                return self.resolveSub(args, value)
+            if function == 'Fn::Join':
+                return self.resolveJoin(args, value)
+            if function == 'Fn::Select':
+                return self.resolveSelect(args, value)
+        return value
+
+    def resolveRef(self, name, prop):
+        return self.refs.get(name, prop)
+
+    def resolveGetAtt(self, args, prop):
+        if isinstance(args, str):
+            args = args.split('.', 1)
+        if not isinstance(args, list) or len(args) != 2 or not all(isinstance(arg, str) for arg in args):
+            return prop
+        return self.attributes.get((args[0], args[1]), prop)
+
+    def resolveSub(self, args, prop):
+        if isinstance(args, str):
+            if args not in self.memo:
+                self.memo[args] = self.substitute(args, {}, self.UNRESOLVED)
+            return prop if self.memo[args] is self.UNRESOLVED else self.memo[args]
+        if not isinstance(args, list) or len(args) != 2 or not isinstance(args[0], str) or not isinstance(args[1], dict):
+            return prop
+        variables = {}
+        for name, value in args[1].items():
+            variables[name] = self.resolvePropertyValue(value)
+        return self.substitute(args[0], variables, prop)
+
+    def substitute(self, string, variables, prop):
+        values = []
+        for variable in self.SUB_VARIABLE.findall(string):
+            if variable.startswith('!'):
+                continue
+            if variable in variables:
+                value = variables[variable]
+            elif '.' in variable:
+                value = self.resolveGetAtt(variable, None)
+            else:
+                value = self.resolveRef(variable, None)
+            if not isinstance(value, str):
+                return prop # only substitute once every variable is known
+            values.append(value)
+
+        values.reverse()
+        def replace(match):
+            if match.group(1).startswith('!'):
+                return '${' + match.group(1)[1:] + '}'
+            return values.pop()
+        return self.SUB_VARIABLE.sub(replace, string)
+
+    def resolveJoin(self, args, prop):
+        if not isinstance(args, list) or len(args) != 2 or not isinstance(args[0], str):
+            return prop
+        items = self.resolvePropertyValue(args[1])
+        if isinstance(items, list) and all(isinstance(item, str) for item in items):
+            return args[0].join(items)
+        if items is args[1]:
+            return prop
+        return {
+            'Fn::Join': [args[0], items]
+        }
+
+    def resolveSelect(self, args, prop):
+        if not isinstance(args, list) or len(args) != 2:
+            return prop
+        index = self.resolvePropertyValue(args[0])
+        items = self.resolvePropertyValue(args[1])
+        if isinstance(items, list) and str(index).isdigit() and int(index) < len(items):
+            return items[int(index)]
+        if index is args[0] and items is args[1]:
+            return prop
+        return {
+            'Fn::Select': [index, items]
+        }
+
+    def referenceActualProperties(self, actual, template_value):
+        # puts the template's intrinsics back wherever they resolve to exactly the deployed value,
+        # returning actual itself when there's nothing to put back
+        references = {}
+        counterparts = {(): actual} # the node of actual at each path of template_value visited so far
+
+        def findReferences(path, value):
+            if path:
+                parent = counterparts.get(path[:-1])
+                if isinstance(parent, dict) and path[-1] in parent:
+                    counterparts[path] = parent[path[-1]]
+                elif isinstance(parent, list) and isinstance(path[-1], int) and path[-1] < len(parent):
+                    counterparts[path] = parent[path[-1]]
                 else:
-                    resolve_matches['GetAtt' + prop['Fn::GetAtt'][0] + prop['Fn::GetAtt'][1]] = {
-                        'Fn::GetAtt': prop['Fn::GetAtt']
-                    }
-        elif 'Fn::Sub' in prop:
-            pass # TODO
-        
-        ret = {}
-        for k, v in prop.items():
-            ret[k] = resolvePropertyValue(v, match_resources, replace_values)
-        return ret
-    elif isinstance(prop, list) and not isinstance(prop, str):
-        ret = []
-        for listitem in prop:
-            ret.append(resolvePropertyValue(listitem, match_resources, replace_values))
-        return ret
+                    return WALK_SKIP
+            if isinstance(value, dict) and len(value) == 1 and next(iter(value)) in self.FUNCTIONS:
+                if self.resolvePropertyValue(value) == counterparts[path]:
+                    references[path] = value
+                return WALK_SKIP
+            if isinstance(value, list) and not (isinstance(counterparts[path], list) and len(counterparts[path]) == len(value)):
+                return WALK_SKIP
+            return value
+
+        walkTemplate(template_value, findReferences)
+        if not references:
+            return actual
+
+        prefixes = set(path[:i] for path in references for i in range(len(path)))
+        def putReferences(path, value):
+            if path in references:
+                return references[path]
+            return value if path in prefixes else WALK_SKIP
+        return walkTemplate(actual, putReferences)
+
+def urlSuffix(partition):
+    return 'amazonaws.com.cn' if partition == 'aws-cn' else 'amazonaws.com'
+
+def parameterRefs(stack_id, template, stack_params):
+    # Ref values of a stack's parameters and the pseudo parameters that don't depend on its name
+    arn_parts = stack_id.split(':')
+    refs = {
+        'AWS::Partition': arn_parts[1],
+        'AWS::Region': arn_parts[3],
+        'AWS::AccountId': arn_parts[4],
+        'AWS::URLSuffix': urlSuffix(arn_parts[1])
+    }
+    parameter_types = {k: v.get('Type', 'String') for k, v in template.get('Parameters', {}).items()}
+    for parameter in stack_params:
+        value = parameter.get('ResolvedValue', parameter.get('ParameterValue'))
+        if value is None or value == '****':
+            continue
+        if parameter_types.get(parameter['ParameterKey'], 'String') == 'CommaDelimitedList' or parameter_types.get(parameter['ParameterKey'], 'String').startswith('List<'):
+            value = value.split(',')
+        refs[parameter['ParameterKey']] = value
+    return refs
+
+def pinImportValues(template, export_values, resolver):
+    # swaps Fn::ImportValue of the given exports for their literal values, returning the new template
+    # and the names of the exports it pinned
+    pinned = set()
+
+    def visit(path, value):
+        if isinstance(value, dict) and len(value) == 1 and 'Fn::ImportValue' in value:
+            export_name = resolver.resolvePropertyValue(value['Fn::ImportValue'])
+            if isinstance(export_name, str) and export_name in export_values:
+                pinned.add(export_name)
+                return export_values[export_name]
+            return WALK_SKIP
+        return value
+
+    return walkTemplate(template, visit), pinned
+
+class RenameError(Exception):
+    pass
+
+class WaitEngine:
+    """Polls until an operation settles, starting fast and backing off exponentially with jitter.
+
+    Phases describe what to wait for as a (phase, poll) request, where poll() returns None while
+    the operation is in progress and its final result otherwise. wait() sleeps between polls on
+    the calling thread; waitAsync() sleeps on the event loop and only borrows a thread to poll.
+    """
+
+    def __init__(self, initial_delay=2, max_delay=30, backoff=1.5, jitter=0.2, timeout=3600, log=print):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.jitter = jitter
+        self.timeout = timeout
+        self.log = log
+        self.phases = []
+
+    def wait(self, phase, poll):
+        started = time.time()
+        slept = 0.0
+        polls = 0
+        delays = self.delays(phase, started)
+        while True:
+            polls += 1
+            result = poll()
+            if result is not None:
+                break
+            sleep_for = next(delays)
+            time.sleep(sleep_for)
+            slept += sleep_for
+
+        return self.recordWait(phase, started, slept, polls, result)
+
+    async def waitAsync(self, phase, poll, executor=None):
+        loop = asyncio.get_running_loop()
+        started = time.time()
+        slept = 0.0
+        polls = 0
+        delays = self.delays(phase, started)
+        while True:
+            polls += 1
+            result = await loop.run_in_executor(executor, poll)
+            if result is not None:
+                break
+            sleep_for = next(delays)
+            await asyncio.sleep(sleep_for)
+            slept += sleep_for
+
+        return self.recordWait(phase, started, slept, polls, result)
+
+    def delays(self, phase, started):
+        delay = self.initial_delay
+        while True:
+            if time.time() - started >= self.timeout:
+                raise RenameError("Timed out waiting for " + phase)
+            yield min(delay, self.max_delay) * random.uniform(1 - self.jitter, 1 + self.jitter)
+            delay *= self.backoff
+
+    def recordWait(self, phase, started, slept, polls, result):
+        elapsed = time.time() - started
+        self.phases.append({
+            'Phase': phase,
+            'Elapsed': elapsed,
+            'Slept': slept,
+            'Polls': polls
+        })
+        self.log("{} took {:.1f}s ({:.1f}s waiting, {} polls)".format(phase, elapsed, slept, polls))
+        return result
+
+    def stackWait(self, cfnclient, phase, stack_id, success_statuses, missing_ok=False):
+        def poll():
+            try:
+                stack = cfnclient.describe_stacks(
+                    StackName=stack_id
+                )['Stacks'][0]
+            except ClientError as e:
+                if missing_ok and 'does not exist' in str(e):
+                    return 'DELETE_COMPLETE'
+                raise
+            if stack['StackStatus'] in success_statuses:
+                return stack['StackStatus']
+            if stack['StackStatus'].endswith('_IN_PROGRESS'):
+                return None
+            raise RenameError("Stack entered unexpected status " + stack['StackStatus'] + " during " + phase + ": " + stack.get('StackStatusReason', 'no reason given'))
+
+        return (phase, poll)
+
+    def settleWait(self, cfnclient, phase, stack_id):
+        def poll():
+            try:
+                stack = cfnclient.describe_stacks(
+                    StackName=stack_id
+                )['Stacks'][0]
+            except ClientError as e:
+                if 'does not exist' in str(e):
+                    return 'DELETE_COMPLETE'
+                raise
+            if stack['StackStatus'].endswith('_IN_PROGRESS') and stack['StackStatus'] != 'REVIEW_IN_PROGRESS':
+                return None
+            return stack['StackStatus']
+
+        return (phase, poll)
+
+    def changeSetWait(self, cfnclient, phase, stack_id, change_set_name):
+        def poll():
+            change_set = cfnclient.describe_change_set(
+                StackName=stack_id,
+                ChangeSetName=change_set_name
+            )
+            if change_set['Status'] == 'CREATE_COMPLETE':
+                return change_set
+            if change_set['Status'] in ['CREATE_PENDING', 'CREATE_IN_PROGRESS']:
+                return None
+            raise RenameError("Change set entered unexpected status " + change_set['Status'] + ": " + change_set.get('StatusReason', 'no reason given'))
+
+        return (phase, poll)
+
+class RunRecorder:
+    """Records per-phase timings and CloudFormation API usage for one rename.
+
+    If opentelemetry is installed, each phase and API call is also emitted as a span.
+    """
+
+    THROTTLING_CODES = ['Throttling', 'ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded']
+
+    def __init__(self, stack_name, new_stack_name, wait_engine):
+        self.stack_name = stack_name
+        self.new_stack_name = new_stack_name
+        self.wait_engine = wait_engine
+        self.phases = []
+        self.current_phase = None
+        self.started = None
+        self.finished = None
+        self.new_stack_id = None
+        self.error = None
+        self.plan = None
+        self.lock = threading.Lock() # nested stacks are described from several threads at once
+        self.tracer = trace.get_tracer('cfn-stack-rename') if trace is not None else None
+
+    def start(self):
+        self.started = time.time()
+
+    def finish(self, new_stack_id=None, error=None):
+        self.finished = time.time()
+        self.new_stack_id = new_stack_id
+        self.error = error
+
+    @contextmanager
+    def phase(self, name):
+        phase = {
+            'Phase': name,
+            'Status': 'SUCCEEDED',
+            'Elapsed': 0.0,
+            'Calls': 0,
+            'Retries': 0,
+            'Throttles': 0,
+            'Errors': 0,
+            'BytesSent': 0,
+            'BytesReceived': 0,
+            'TemplateBytes': [],
+            'Operations': OrderedDict(),
+            'Waits': []
+        }
+        self.phases.append(phase)
+        self.current_phase = phase
+        waits_before = len(self.wait_engine.phases)
+        started = time.time()
+        span = self.tracer.start_as_current_span('rename.' + name, attributes={'stack.name': self.stack_name}) if self.tracer else nullcontext()
+        try:
+            with span:
+                yield phase
+        except:
+            phase['Status'] = 'FAILED'
+            raise
+        finally:
+            phase['Elapsed'] = time.time() - started
+            phase['Waits'] = self.wait_engine.phases[waits_before:]
+            self.current_phase = None
+
+    def recordTemplate(self, template_size):
+        if self.current_phase is not None:
+            self.current_phase['TemplateBytes'].append(template_size)
+
+    def recordCall(self, operation, kwargs, call):
+        phase = self.current_phase
+        if phase is None: # calls made outside run(), e.g. a phase method invoked directly
+            return call()
+
+        with self.lock:
+            operation_stats = phase['Operations'].setdefault(operation, {
+                'Calls': 0,
+                'Latency': 0.0,
+                'BytesReceived': 0
+            })
+            phase['Calls'] += 1
+            operation_stats['Calls'] += 1
+            phase['BytesSent'] += len(json.dumps(kwargs, default=str))
+
+        span = self.tracer.start_as_current_span('cloudformation.' + operation) if self.tracer else nullcontext()
+        started = time.time()
+        try:
+            with span:
+                response = call()
+        except ClientError as e:
+            with self.lock:
+                phase['Errors'] += 1
+                phase['Retries'] += e.response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+                if e.response.get('Error', {}).get('Code') in self.THROTTLING_CODES:
+                    phase['Throttles'] += 1
+            raise
+        finally:
+            with self.lock:
+                operation_stats['Latency'] += time.time() - started
+
+        metadata = response.get('ResponseMetadata', {}) if isinstance(response, dict) else {}
+        if 'content-length' in metadata.get('HTTPHeaders', {}):
+            bytes_received = int(metadata['HTTPHeaders']['content-length'])
+        else: # clients that don't report it, like the benchmark's, are sized by their JSON
+            bytes_received = len(json.dumps(response, default=str)) if isinstance(response, dict) else 0
+        with self.lock:
+            phase['Retries'] += metadata.get('RetryAttempts', 0)
+            phase['BytesReceived'] += bytes_received
+            operation_stats['BytesReceived'] += bytes_received
+        return response
+
+    def operationTotal(self, operation, stat):
+        return sum(phase['Operations'][operation][stat] for phase in self.phases if operation in phase['Operations'])
+
+    def report(self):
+        return {
+            'StackName': self.stack_name,
+            'NewStackName': self.new_stack_name,
+            'NewStackId': self.new_stack_id,
+            'Status': 'FAILED' if self.error else 'SUCCEEDED',
+            'Error': str(self.error) if self.error else None,
+            'Elapsed': (self.finished or time.time()) - self.started if self.started else 0.0,
+            'Calls': sum(phase['Calls'] for phase in self.phases),
+            'DriftPages': self.operationTotal('describe_stack_resource_drifts', 'Calls'),
+            'DriftBytes': self.operationTotal('describe_stack_resource_drifts', 'BytesReceived'),
+            'Plan': self.plan,
+            'Phases': self.phases
+        }
+
+class InstrumentedClient:
+    """Wraps a CloudFormation client so every call is recorded against the current phase."""
+
+    def __init__(self, cfnclient, recorder):
+        self._cfnclient = cfnclient
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        method = getattr(self._cfnclient, name)
+        if not callable(method):
+            return method
+
+        def instrumented(**kwargs):
+            return self._recorder.recordCall(name, kwargs, lambda: method(**kwargs))
+        return instrumented
+
+class DriftCache:
+    """On-disk cache of resource drift results, keyed by stack ID and the stack's last update time."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, stack_id, last_updated):
+        key = hashlib.sha256((stack_id + '|' + str(last_updated)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + '.json')
+
+    def load(self, stack_id, last_updated, last_check):
+        try:
+            with open(self.path(stack_id, last_updated)) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached['StackId'] != stack_id or cached['LastCheckTimestamp'] != str(last_check):
+            return None
+        return cached['StackResourceDrifts']
+
+    def save(self, stack_id, last_updated, last_check, resource_drifts):
+        path = self.path(stack_id, last_updated)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({
+                'StackId': stack_id,
+                'LastUpdatedTime': str(last_updated),
+                'LastCheckTimestamp': str(last_check),
+                'StackResourceDrifts': resource_drifts
+            }, f, default=str)
+        os.replace(path + '.tmp', path)
+
+class PropertyStore:
+    """On-disk store for large ActualProperties blobs, so huge drift results needn't sit in memory.
+
+    Blobs are written under the SHA-256 of their content, so the keys stay valid in journals and the
+    drift cache until release() deletes them. Renames sharing the store only delete a blob once none
+    of them still holds it.
+    """
+
+    def __init__(self, directory, threshold=65536):
+        self.directory = directory
+        self.threshold = threshold
+        self.holders = {} # by key, the number of puts not yet released
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def put(self, blob):
+        key = hashlib.sha256(blob.encode('utf-8')).hexdigest()
+        path = self.path(key)
+        if not os.path.exists(path):
+            tmp_path = path + '.' + str(threading.get_ident()) + '.tmp' # renames in a batch share the store
+            with open(tmp_path, 'w') as f:
+                f.write(blob)
+            os.replace(tmp_path, path)
+        with self.lock:
+            self.holders[key] = self.holders.get(key, 0) + 1
+        return key
+
+    def release(self, keys):
+        for key in keys:
+            with self.lock:
+                self.holders[key] = self.holders.get(key, 0) - 1 # keys restored from a journal were put by an earlier run
+                if self.holders[key] > 0:
+                    continue
+                del self.holders[key]
+                try:
+                    os.remove(self.path(key))
+                except FileNotFoundError:
+                    pass
+
+    def get(self, key):
+        try:
+            with open(self.path(key)) as f:
+                return f.read()
+        except OSError:
+            raise RenameError("Spilled drift properties " + key + " are missing from " + self.directory)
+
+class TemplateStager:
+    """Uploads templates too large to send inline to S3, so they can be passed by TemplateURL instead.
+
+    Objects are keyed by the SHA-256 of their body, so an identical template is only uploaded once.
+    """
+
+    MAX_TEMPLATE_BODY_SIZE = 51200
+    MAX_TEMPLATE_URL_SIZE = 1000000
+
+    def __init__(self, s3client, bucket, prefix='cfn-stack-rename/', log=print):
+        self.s3client = s3client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.log = log
+        self.uploaded_keys = set()
+        self.lock = threading.Lock()
+
+    def templateArgs(self, template_body):
+        body = template_body.encode('utf-8')
+        if len(body) <= self.MAX_TEMPLATE_BODY_SIZE:
+            return {
+                'TemplateBody': template_body
+            }
+        return {
+            'TemplateURL': self.stage(body)
+        }
+
+    def stage(self, body):
+        key = self.prefix + hashlib.sha256(body).hexdigest() + '.json'
+        with self.lock:
+            already_uploaded = key in self.uploaded_keys
+        if not already_uploaded:
+            try:
+                self.s3client.head_object(Bucket=self.bucket, Key=key)
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') not in ['404', 'NoSuchKey', 'NotFound']:
+                    raise
+                self.log("Staging {} byte template in s3://{}/{}".format(len(body), self.bucket, key))
+                self.s3client.put_object(
+                    Bucket=self.bucket,
+                    Key=key,
+                    Body=body,
+                    ContentType='application/json'
+                )
+            with self.lock:
+                self.uploaded_keys.add(key)
+        return self.url(key)
+
+    def url(self, key):
+        region = self.s3client.meta.region_name
+        if region in [None, 'us-east-1']:
+            return 'https://{}.s3.amazonaws.com/{}'.format(self.bucket, key)
+        return 'https://{}.s3.{}.{}/{}'.format(self.bucket, region, urlSuffix('aws-cn' if region.startswith('cn-') else 'aws'), key)
+
+def parseTemplate(template_body):
+    try:
+        return json.loads(template_body)
+    except ValueError:
+        return json.loads(to_json(template_body)) # YAML
+
+def serializeTemplate(template):
+    # templates are billed against a byte limit, so skip the whitespace json.dumps adds by default
+    return json.dumps(template, separators=(',', ':'))
+
+def pruneActualProperties(actual_properties, template_properties):
+    # ActualProperties echoes unset properties back as empty values; only keep those the template sets
+    return {
+        k: v for k, v in actual_properties.items()
+        if k in template_properties or v not in [None, '', [], {}]
+    }
+
+def diffTemplates(old_template, new_template, ignored_resource_attributes=[]):
+    # structural diff as a list of (path, 'added' | 'removed' | 'changed'), paths being key tuples
+    changes = []
+
+    def ignored(path):
+        return len(path) == 3 and path[0] == 'Resources' and path[2] in ignored_resource_attributes
+
+    counterparts = {(): new_template} # the node of new_template at each dict path of old_template visited so far
+
+    def compare(path, old):
+        new = new_template
+        if path:
+            parent = counterparts[path[:-1]]
+            if ignored(path):
+                return WALK_SKIP
+            if path[-1] not in parent:
+                changes.append((path, 'removed'))
+                return WALK_SKIP
+            new = parent[path[-1]]
+        if isinstance(old, dict) and isinstance(new, dict):
+            counterparts[path] = new
+            for k in new:
+                if k not in old and not ignored(path + (k,)):
+                    changes.append((path + (k,), 'added'))
+            return old
+        if old != new:
+            changes.append((path, 'changed'))
+        return WALK_SKIP
+
+    walkTemplate(old_template, compare)
+    return changes
+
+def summarizeChanges(changes, limit=10):
+    summary = ', '.join(['.'.join([str(part) for part in path]) + ' (' + change + ')' for path, change in changes[:limit]])
+    if len(changes) > limit:
+        summary += ' and {} more'.format(len(changes) - limit)
+    return summary
+
+def summarizePlan(plan):
+    summary = "import {} resource(s)".format(plan['Imports'])
+    if plan['NestedStacks']:
+        summary += " ({} nested stack(s) below)".format(plan['NestedStacks'])
+    if plan['Skipped']:
+        summary += ", skip {} undeployed".format(len(plan['Skipped']))
+    if plan['RetainUpdate']:
+        summary += ", retain update on {} ({} template)".format(plan['RetainUpdate'], plan['RetainTemplate'])
     else:
-        return prop
-
-eligible_import_resources = { # from Former2
-    "AWS::ACMPCA::Certificate": {
-        "importProperties": [
-            "Arn",
-            "CertificateAuthorityArn"
-        ]
-    },
-    "AWS::ACMPCA::CertificateAuthority": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::ACMPCA::CertificateAuthorityActivation": {
-        "importProperties": [
-            "CertificateAuthorityArn"
-        ]
-    },
-    "AWS::AccessAnalyzer::Analyzer": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::ApiGateway::Authorizer": {
-        "importProperties": [
-            "RestApiId",
-            "AuthorizerId"
-        ]
-    },
-    "AWS::ApiGateway::ClientCertificate": {
-        "importProperties": [
-            "ClientCertificateId"
-        ]
-    },
-    "AWS::ApiGateway::Deployment": {
-        "importProperties": [
-            "RestApiId",
-            "DeploymentId"
-        ]
-    },
-    "AWS::ApiGateway::DocumentationVersion": {
-        "importProperties": [
-            "DocumentationVersion",
-            "RestApiId"
-        ]
-    },
-    "AWS::ApiGateway::DomainName": {
-        "importProperties": [
-            "DomainName"
-        ]
-    },
-    "AWS::ApiGateway::Method": {
-        "importProperties": [
-            "RestApiId",
-            "ResourceId",
-            "HttpMethod"
-        ]
-    },
-    "AWS::ApiGateway::Model": {
-        "importProperties": [
-            "RestApiId",
-            "Name"
-        ]
-    },
-    "AWS::ApiGateway::RequestValidator": {
-        "importProperties": [
-            "RestApiId",
-            "RequestValidatorId"
-        ]
-    },
-    "AWS::ApiGateway::Resource": {
-        "importProperties": [
-            "RestApiId",
-            "ResourceId"
-        ]
-    },
-    "AWS::ApiGateway::RestApi": {
-        "importProperties": [
-            "RestApiId"
-        ]
-    },
-    "AWS::ApiGateway::Stage": {
-        "importProperties": [
-            "RestApiId",
-            "StageName"
-        ]
-    },
-    "AWS::AppFlow::ConnectorProfile": {
-        "importProperties": [
-            "ConnectorProfileName"
-        ]
-    },
-    "AWS::AppFlow::Flow": {
-        "importProperties": [
-            "FlowName"
-        ]
-    },
-    "AWS::ApplicationInsights::Application": {
-        "importProperties": [
-            "ApplicationARN"
-        ]
-    },
-    "AWS::Athena::DataCatalog": {
-        "importProperties": [
-            "Name"
-        ]
-    },
-    "AWS::Athena::NamedQuery": {
-        "importProperties": [
-            "NamedQueryId"
-        ]
-    },
-    "AWS::Athena::WorkGroup": {
-        "importProperties": [
-            "Name"
-        ]
-    },
-    "AWS::AuditManager::Assessment": {
-        "importProperties": [
-            "AssessmentId"
-        ]
-    },
-    "AWS::AutoScaling::AutoScalingGroup": {
-        "importProperties": [
-            "AutoScalingGroupName"
-        ]
-    },
-    "AWS::AutoScaling::LaunchConfiguration": {
-        "importProperties": [
-            "LaunchConfigurationName"
-        ]
-    },
-    "AWS::AutoScaling::LifecycleHook": {
-        "importProperties": [
-            "AutoScalingGroupName",
-            "LifecycleHookName"
-        ]
-    },
-    "AWS::AutoScaling::ScalingPolicy": {
-        "importProperties": [
-            "PolicyName"
-        ]
-    },
-    "AWS::AutoScaling::ScheduledAction": {
-        "importProperties": [
-            "ScheduledActionName"
-        ]
-    },
-    "AWS::CE::CostCategory": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::Cassandra::Keyspace": {
-        "importProperties": [
-            "KeyspaceName"
-        ]
-    },
-    "AWS::Cassandra::Table": {
-        "importProperties": [
-            "KeyspaceName",
-            "TableName"
-        ]
-    },
-    "AWS::Chatbot::SlackChannelConfiguration": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::CloudFormation::ModuleDefaultVersion": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::CloudFormation::ModuleVersion": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::CloudFormation::Stack": {
-        "importProperties": [
-            "StackId"
-        ]
-    },
-    "AWS::CloudFormation::StackSet": {
-        "importProperties": [
-            "StackSetId"
-        ]
-    },
-    "AWS::CloudFront::CachePolicy": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::CloudFront::KeyGroup": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::CloudFront::OriginRequestPolicy": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::CloudFront::PublicKey": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::CloudFront::RealtimeLogConfig": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::CloudTrail::Trail": {
-        "importProperties": [
-            "TrailName"
-        ]
-    },
-    "AWS::CloudWatch::Alarm": {
-        "importProperties": [
-            "AlarmName"
-        ]
-    },
-    "AWS::CloudWatch::CompositeAlarm": {
-        "importProperties": [
-            "AlarmName"
-        ]
-    },
-    "AWS::CloudWatch::MetricStream": {
-        "importProperties": [
-            "Name"
-        ]
-    },
-    "AWS::CodeArtifact::Domain": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::CodeArtifact::Repository": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::CodeGuruProfiler::ProfilingGroup": {
-        "importProperties": [
-            "ProfilingGroupName"
-        ]
-    },
-    "AWS::CodeGuruReviewer::RepositoryAssociation": {
-        "importProperties": [
-            "AssociationArn"
-        ]
-    },
-    "AWS::CodeStarConnections::Connection": {
-        "importProperties": [
-            "ConnectionArn"
-        ]
-    },
-    "AWS::Config::ConformancePack": {
-        "importProperties": [
-            "ConformancePackName"
-        ]
-    },
-    "AWS::Config::OrganizationConformancePack": {
-        "importProperties": [
-            "OrganizationConformancePackName"
-        ]
-    },
-    "AWS::Config::StoredQuery": {
-        "importProperties": [
-            "QueryName"
-        ]
-    },
-    "AWS::DataBrew::Dataset": {
-        "importProperties": [
-            "Name"
-        ]
-    },
-    "AWS::DataBrew::Job": {
-        "importProperties": [
-            "Name"
-        ]
-    },
-    "AWS::DataBrew::Project": {
-        "importProperties": [
-            "Name"
-        ]
-    },
-    "AWS::DataBrew::Recipe": {
-        "importProperties": [
-            "Name"
-        ]
-    },
-    "AWS::DataBrew::Schedule": {
-        "importProperties": [
-            "Name"
-        ]
-    },
-    "AWS::DataSync::Agent": {
-        "importProperties": [
-            "AgentArn"
-        ]
-    },
-    "AWS::DataSync::LocationEFS": {
-        "importProperties": [
-            "LocationArn"
-        ]
-    },
-    "AWS::DataSync::LocationFSxWindows": {
-        "importProperties": [
-            "LocationArn"
-        ]
-    },
-    "AWS::DataSync::LocationNFS": {
-        "importProperties": [
-            "LocationArn"
-        ]
-    },
-    "AWS::DataSync::LocationObjectStorage": {
-        "importProperties": [
-            "LocationArn"
-        ]
-    },
-    "AWS::DataSync::LocationS3": {
-        "importProperties": [
-            "LocationArn"
-        ]
-    },
-    "AWS::DataSync::LocationSMB": {
-        "importProperties": [
-            "LocationArn"
-        ]
-    },
-    "AWS::DataSync::Task": {
-        "importProperties": [
-            "TaskArn"
-        ]
-    },
-    "AWS::Detective::Graph": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::Detective::MemberInvitation": {
-        "importProperties": [
-            "GraphArn",
-            "MemberId"
-        ]
-    },
-    "AWS::DevOpsGuru::NotificationChannel": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::DevOpsGuru::ResourceCollection": {
-        "importProperties": [
-            "ResourceCollectionType"
-        ]
-    },
-    "AWS::DynamoDB::Table": {
-        "importProperties": [
-            "TableName"
-        ]
-    },
-    "AWS::DynamoDB::GlobalTable": {
-        "importProperties": [
-            "TableName"
-        ]
-    },
-    "AWS::EC2::CarrierGateway": {
-        "importProperties": [
-            "CarrierGatewayId"
-        ]
-    },
-    "AWS::EC2::EIP": {
-        "importProperties": [
-            "PublicIp"
-        ]
-    },
-    "AWS::EC2::FlowLog": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::EC2::GatewayRouteTableAssociation": {
-        "importProperties": [
-            "GatewayId"
-        ]
-    },
-    "AWS::EC2::Instance": {
-        "importProperties": [
-            "InstanceId"
-        ]
-    },
-    "AWS::EC2::InternetGateway": {
-        "importProperties": [
-            "InternetGatewayId"
-        ]
-    },
-    "AWS::EC2::LocalGatewayRoute": {
-        "importProperties": [
-            "DestinationCidrBlock",
-            "LocalGatewayRouteTableId"
-        ]
-    },
-    "AWS::EC2::LocalGatewayRouteTableVPCAssociation": {
-        "importProperties": [
-            "LocalGatewayRouteTableVpcAssociationId"
-        ]
-    },
-    "AWS::EC2::NatGateway": {
-        "importProperties": [
-            "NatGatewayId"
-        ]
-    },
-    "AWS::EC2::NetworkAcl": {
-        "importProperties": [
-            "NetworkAclId"
-        ]
-    },
-    "AWS::EC2::NetworkInsightsAnalysis": {
-        "importProperties": [
-            "NetworkInsightsAnalysisId"
-        ]
-    },
-    "AWS::EC2::NetworkInsightsPath": {
-        "importProperties": [
-            "NetworkInsightsPathId"
-        ]
-    },
-    "AWS::EC2::NetworkInterface": {
-        "importProperties": [
-            "NetworkInterfaceId"
-        ]
-    },
-    "AWS::EC2::PrefixList": {
-        "importProperties": [
-            "PrefixListId"
-        ]
-    },
-    "AWS::EC2::RouteTable": {
-        "importProperties": [
-            "RouteTableId"
-        ]
-    },
-    "AWS::EC2::SecurityGroup": {
-        "importProperties": [
-            "GroupId"
-        ]
-    },
-    "AWS::EC2::Subnet": {
-        "importProperties": [
-            "SubnetId"
-        ]
-    },
-    "AWS::EC2::VPC": {
-        "importProperties": [
-            "VpcId"
-        ]
-    },
-    "AWS::EC2::Volume": {
-        "importProperties": [
-            "VolumeId"
-        ]
-    },
-    "AWS::ECR::PublicRepository": {
-        "importProperties": [
-            "RepositoryName"
-        ]
-    },
-    "AWS::ECR::Repository": {
-        "importProperties": [
-            "RepositoryName"
-        ]
-    },
-    "AWS::ECS::CapacityProvider": {
-        "importProperties": [
-            "Name"
-        ]
-    },
-    "AWS::ECS::Cluster": {
-        "importProperties": [
-            "ClusterName"
-        ]
-    },
-    "AWS::ECS::PrimaryTaskSet": {
-        "importProperties": [
-            "Cluster",
-            "Service"
-        ]
-    },
-    "AWS::ECS::Service": {
-        "importProperties": [
-            "ServiceArn",
-            "Cluster"
-        ]
-    },
-    "AWS::ECS::TaskDefinition": {
-        "importProperties": [
-            "TaskDefinitionArn"
-        ]
-    },
-    "AWS::ECS::TaskSet": {
-        "importProperties": [
-            "Cluster",
-            "Service",
-            "Id"
-        ]
-    },
-    "AWS::EFS::AccessPoint": {
-        "importProperties": [
-            "AccessPointId"
-        ]
-    },
-    "AWS::EFS::FileSystem": {
-        "importProperties": [
-            "FileSystemId"
-        ]
-    },
-    "AWS::EKS::FargateProfile": {
-        "importProperties": [
-            "ClusterName",
-            "FargateProfileName"
-        ]
-    },
-    "AWS::ElastiCache::User": {
-        "importProperties": [
-            "UserId"
-        ]
-    },
-    "AWS::ElastiCache::UserGroup": {
-        "importProperties": [
-            "UserGroupId"
-        ]
-    },
-    "AWS::ElasticLoadBalancing::LoadBalancer": {
-        "importProperties": [
-            "LoadBalancerName"
-        ]
-    },
-    "AWS::ElasticLoadBalancingV2::Listener": {
-        "importProperties": [
-            "ListenerArn"
-        ]
-    },
-    "AWS::ElasticLoadBalancingV2::ListenerRule": {
-        "importProperties": [
-            "RuleArn"
-        ]
-    },
-    "AWS::ElasticLoadBalancingV2::LoadBalancer": {
-        "importProperties": [
-            "LoadBalancerArn"
-        ]
-    },
-    "AWS::EventSchemas::RegistryPolicy": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::Events::Archive": {
-        "importProperties": [
-            "ArchiveName"
-        ]
-    },
-    "AWS::Events::Rule": {
-        "importProperties": [
-            "Name"
-        ]
-    },
-    "AWS::FMS::NotificationChannel": {
-        "importProperties": [
-            "SnsTopicArn"
-        ]
-    },
-    "AWS::FMS::Policy": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::GameLift::Alias": {
-        "importProperties": [
-            "AliasId"
-        ]
-    },
-    "AWS::GameLift::GameServerGroup": {
-        "importProperties": [
-            "GameServerGroupArn"
-        ]
-    },
-    "AWS::GlobalAccelerator::Accelerator": {
-        "importProperties": [
-            "AcceleratorArn"
-        ]
-    },
-    "AWS::GlobalAccelerator::EndpointGroup": {
-        "importProperties": [
-            "EndpointGroupArn"
-        ]
-    },
-    "AWS::GlobalAccelerator::Listener": {
-        "importProperties": [
-            "ListenerArn"
-        ]
-    },
-    "AWS::Glue::Registry": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::Glue::Schema": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::Glue::SchemaVersion": {
-        "importProperties": [
-            "VersionId"
-        ]
-    },
-    "AWS::Glue::SchemaVersionMetadata": {
-        "importProperties": [
-            "SchemaVersionId",
-            "Key",
-            "Value"
-        ]
-    },
-    "AWS::GreengrassV2::ComponentVersion": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::IVS::Channel": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::IVS::PlaybackKeyPair": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::IVS::StreamKey": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::ImageBuilder::Component": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::ImageBuilder::DistributionConfiguration": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::ImageBuilder::Image": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::ImageBuilder::ImagePipeline": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::ImageBuilder::ImageRecipe": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::ImageBuilder::InfrastructureConfiguration": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::IoT::Authorizer": {
-        "importProperties": [
-            "AuthorizerName"
-        ]
-    },
-    "AWS::IoT::Certificate": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::IoT::DomainConfiguration": {
-        "importProperties": [
-            "DomainConfigurationName"
-        ]
-    },
-    "AWS::IoT::ProvisioningTemplate": {
-        "importProperties": [
-            "TemplateName"
-        ]
-    },
-    "AWS::IoT::Thing": {
-        "importProperties": [
-            "ThingName"
-        ]
-    },
-    "AWS::IoT::TopicRuleDestination": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::IoTSiteWise::AccessPolicy": {
-        "importProperties": [
-            "AccessPolicyId"
-        ]
-    },
-    "AWS::IoTSiteWise::Asset": {
-        "importProperties": [
-            "AssetId"
-        ]
-    },
-    "AWS::IoTSiteWise::AssetModel": {
-        "importProperties": [
-            "AssetModelId"
-        ]
-    },
-    "AWS::IoTSiteWise::Dashboard": {
-        "importProperties": [
-            "DashboardId"
-        ]
-    },
-    "AWS::IoTSiteWise::Gateway": {
-        "importProperties": [
-            "GatewayId"
-        ]
-    },
-    "AWS::IoTSiteWise::Portal": {
-        "importProperties": [
-            "PortalId"
-        ]
-    },
-    "AWS::IoTSiteWise::Project": {
-        "importProperties": [
-            "ProjectId"
-        ]
-    },
-    "AWS::IoTWireless::Destination": {
-        "importProperties": [
-            "Name"
-        ]
-    },
-    "AWS::IoTWireless::DeviceProfile": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::IoTWireless::ServiceProfile": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::IoTWireless::WirelessDevice": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::IoTWireless::WirelessGateway": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::KMS::Alias": {
-        "importProperties": [
-            "AliasName"
-        ]
-    },
-    "AWS::KMS::Key": {
-        "importProperties": [
-            "KeyId"
-        ]
-    },
-    "AWS::Kendra::DataSource": {
-        "importProperties": [
-            "Id",
-            "IndexId"
-        ]
-    },
-    "AWS::Kendra::Faq": {
-        "importProperties": [
-            "Id",
-            "IndexId"
-        ]
-    },
-    "AWS::Kendra::Index": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::Kinesis::Stream": {
-        "importProperties": [
-            "Name"
-        ]
-    },
-    "AWS::KinesisFirehose::DeliveryStream": {
-        "importProperties": [
-            "DeliveryStreamName"
-        ]
-    },
-    "AWS::Lambda::Alias": {
-        "importProperties": [
-            "AliasArn"
-        ]
-    },
-    "AWS::Lambda::CodeSigningConfig": {
-        "importProperties": [
-            "CodeSigningConfigArn"
-        ]
-    },
-    "AWS::Lambda::EventSourceMapping": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::Lambda::Function": {
-        "importProperties": [
-            "FunctionName"
-        ]
-    },
-    "AWS::Lambda::Version": {
-        "importProperties": [
-            "FunctionArn"
-        ]
-    },
-    "AWS::LicenseManager::Grant": {
-        "importProperties": [
-            "GrantArn"
-        ]
-    },
-    "AWS::LicenseManager::License": {
-        "importProperties": [
-            "LicenseArn"
-        ]
-    },
-    "AWS::Logs::LogGroup": {
-        "importProperties": [
-            "LogGroupName"
-        ]
-    },
-    "AWS::Logs::MetricFilter": {
-        "importProperties": [
-            "FilterName"
-        ]
-    },
-    "AWS::Logs::SubscriptionFilter": {
-        "importProperties": [
-            "LogGroupName",
-            "FilterName"
-        ]
-    },
-    "AWS::MWAA::Environment": {
-        "importProperties": [
-            "Name"
-        ]
-    },
-    "AWS::Macie::CustomDataIdentifier": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::Macie::FindingsFilter": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::Macie::Session": {
-        "importProperties": [
-            "AwsAccountId"
-        ]
-    },
-    "AWS::MediaConnect::Flow": {
-        "importProperties": [
-            "FlowArn"
-        ]
-    },
-    "AWS::MediaConnect::FlowEntitlement": {
-        "importProperties": [
-            "EntitlementArn"
-        ]
-    },
-    "AWS::MediaConnect::FlowOutput": {
-        "importProperties": [
-            "OutputArn"
-        ]
-    },
-    "AWS::MediaConnect::FlowSource": {
-        "importProperties": [
-            "SourceArn"
-        ]
-    },
-    "AWS::MediaConnect::FlowVpcInterface": {
-        "importProperties": [
-            "FlowArn",
-            "Name"
-        ]
-    },
-    "AWS::MediaPackage::Asset": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::MediaPackage::Channel": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::MediaPackage::OriginEndpoint": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::MediaPackage::PackagingConfiguration": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::MediaPackage::PackagingGroup": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::NetworkFirewall::Firewall": {
-        "importProperties": [
-            "FirewallArn"
-        ]
-    },
-    "AWS::NetworkFirewall::FirewallPolicy": {
-        "importProperties": [
-            "FirewallPolicyArn"
-        ]
-    },
-    "AWS::NetworkFirewall::LoggingConfiguration": {
-        "importProperties": [
-            "FirewallArn"
-        ]
-    },
-    "AWS::NetworkFirewall::RuleGroup": {
-        "importProperties": [
-            "RuleGroupArn"
-        ]
-    },
-    "AWS::NetworkManager::CustomerGatewayAssociation": {
-        "importProperties": [
-            "GlobalNetworkId",
-            "CustomerGatewayArn"
-        ]
-    },
-    "AWS::NetworkManager::Device": {
-        "importProperties": [
-            "GlobalNetworkId",
-            "DeviceId"
-        ]
-    },
-    "AWS::NetworkManager::GlobalNetwork": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::NetworkManager::Link": {
-        "importProperties": [
-            "GlobalNetworkId",
-            "LinkId"
-        ]
-    },
-    "AWS::NetworkManager::LinkAssociation": {
-        "importProperties": [
-            "GlobalNetworkId",
-            "DeviceId",
-            "LinkId"
-        ]
-    },
-    "AWS::NetworkManager::Site": {
-        "importProperties": [
-            "GlobalNetworkId",
-            "SiteId"
-        ]
-    },
-    "AWS::NetworkManager::TransitGatewayRegistration": {
-        "importProperties": [
-            "GlobalNetworkId",
-            "TransitGatewayArn"
-        ]
-    },
-    "AWS::OpsWorksCM::Server": {
-        "importProperties": [
-            "ServerName"
-        ]
-    },
-    "AWS::QLDB::Stream": {
-        "importProperties": [
-            "LedgerName",
-            "Id"
-        ]
-    },
-    "AWS::RDS::DBCluster": {
-        "importProperties": [
-            "DBClusterIdentifier"
-        ]
-    },
-    "AWS::RDS::DBInstance": {
-        "importProperties": [
-            "DBInstanceIdentifier"
-        ]
-    },
-    "AWS::RDS::DBProxy": {
-        "importProperties": [
-            "DBProxyName"
-        ]
-    },
-    "AWS::RDS::DBProxyTargetGroup": {
-        "importProperties": [
-            "TargetGroupArn"
-        ]
-    },
-    "AWS::RDS::GlobalCluster": {
-        "importProperties": [
-            "GlobalClusterIdentifier"
-        ]
-    },
-    "AWS::ResourceGroups::Group": {
-        "importProperties": [
-            "Name"
-        ]
-    },
-    "AWS::Route53::DNSSEC": {
-        "importProperties": [
-            "HostedZoneId"
-        ]
-    },
-    "AWS::Route53::HealthCheck": {
-        "importProperties": [
-            "HealthCheckId"
-        ]
-    },
-    "AWS::Route53::HostedZone": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::Route53::KeySigningKey": {
-        "importProperties": [
-            "HostedZoneId",
-            "Name"
-        ]
-    },
-    "AWS::Route53Resolver::ResolverDNSSECConfig": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::Route53Resolver::ResolverQueryLoggingConfig": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::Route53Resolver::ResolverQueryLoggingConfigAssociation": {
-        "importProperties": [
-            "Id"
-        ]
-    },
-    "AWS::S3::AccessPoint": {
-        "importProperties": [
-            "Name"
-        ]
-    },
-    "AWS::S3::Bucket": {
-        "importProperties": [
-            "BucketName"
-        ]
-    },
-    "AWS::SES::ConfigurationSet": {
-        "importProperties": [
-            "Name"
-        ]
-    },
-    "AWS::SNS::Topic": {
-        "importProperties": [
-            "TopicArn"
-        ]
-    },
-    "AWS::SQS::Queue": {
-        "importProperties": [
-            "QueueUrl"
-        ]
-    },
-    "AWS::SSM::Association": {
-        "importProperties": [
-            "AssociationId"
-        ]
-    },
-    "AWS::SSO::InstanceAccessControlAttributeConfiguration": {
-        "importProperties": [
-            "InstanceArn"
-        ]
-    },
-    "AWS::SSO::PermissionSet": {
-        "importProperties": [
-            "InstanceArn",
-            "PermissionSetArn"
-        ]
-    },
-    "AWS::SageMaker::DataQualityJobDefinition": {
-        "importProperties": [
-            "JobDefinitionArn"
-        ]
-    },
-    "AWS::SageMaker::Device": {
-        "importProperties": [
-            "DeviceFleetName"
-        ]
-    },
-    "AWS::SageMaker::DeviceFleet": {
-        "importProperties": [
-            "DeviceFleetName"
-        ]
-    },
-    "AWS::SageMaker::ModelBiasJobDefinition": {
-        "importProperties": [
-            "JobDefinitionArn"
-        ]
-    },
-    "AWS::SageMaker::ModelExplainabilityJobDefinition": {
-        "importProperties": [
-            "JobDefinitionArn"
-        ]
-    },
-    "AWS::SageMaker::ModelPackageGroup": {
-        "importProperties": [
-            "ModelPackageGroupArn"
-        ]
-    },
-    "AWS::SageMaker::ModelQualityJobDefinition": {
-        "importProperties": [
-            "JobDefinitionArn"
-        ]
-    },
-    "AWS::SageMaker::MonitoringSchedule": {
-        "importProperties": [
-            "MonitoringScheduleArn"
-        ]
-    },
-    "AWS::SageMaker::Pipeline": {
-        "importProperties": [
-            "PipelineName"
-        ]
-    },
-    "AWS::SageMaker::Project": {
-        "importProperties": [
-            "ProjectArn"
-        ]
-    },
-    "AWS::ServiceCatalog::CloudFormationProvisionedProduct": {
-        "importProperties": [
-            "ProvisionedProductId"
-        ]
-    },
-    "AWS::Signer::ProfilePermission": {
-        "importProperties": [
-            "StatementId",
-            "ProfileName"
-        ]
-    },
-    "AWS::Signer::SigningProfile": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::StepFunctions::StateMachine": {
-        "importProperties": [
-            "Arn"
-        ]
-    },
-    "AWS::Synthetics::Canary": {
-        "importProperties": [
-            "Name"
-        ]
-    },
-    "AWS::Timestream::Database": {
-        "importProperties": [
-            "DatabaseName"
-        ]
-    },
-    "AWS::Timestream::Table": {
-        "importProperties": [
-            "DatabaseName",
-            "TableName"
-        ]
-    },
-    "AWS::WAFv2::IPSet": {
-        "importProperties": [
-            "Name",
-            "Id",
-            "Scope"
-        ]
-    },
-    "AWS::WAFv2::RegexPatternSet": {
-        "importProperties": [
-            "Name",
-            "Id",
-            "Scope"
-        ]
-    },
-    "AWS::WAFv2::RuleGroup": {
-        "importProperties": [
-            "Name",
-            "Id",
-            "Scope"
-        ]
-    },
-    "AWS::WAFv2::WebACL": {
-        "importProperties": [
-            "Name",
-            "Id",
-            "Scope"
-        ]
-    },
-    "AWS::WAFv2::WebACLAssociation": {
-        "importProperties": [
-            "ResourceArn",
-            "WebACLArn"
-        ]
-    },
-    "AWS::WorkSpaces::ConnectionAlias": {
-        "importProperties": [
-            "AliasId"
-        ]
-    },
-    "AWS::CloudFormation::Stack": {
-        "importProperties": [
-            "StackId"
-        ],
-        "capabilities": [
-            "CAPABILITY_NAMED_IAM"
-        ]
-    },
-    "AWS::IAM::Group": {
-        "importProperties": [
-            "GroupName"
-        ],
-        "capabilities": [
-            "CAPABILITY_NAMED_IAM"
-        ]
-    },
-    "AWS::IAM::InstanceProfile": {
-        "importProperties": [
-            "InstanceProfileName"
-        ],
-        "capabilities": [
-            "CAPABILITY_NAMED_IAM"
-        ]
-    },
-    "AWS::IAM::Role": {
-        "importProperties": [
-            "RoleName"
-        ],
-        "capabilities": [
-            "CAPABILITY_NAMED_IAM"
-        ]
-    },
-    "AWS::IAM::User": {
-        "importProperties": [
-            "UserName"
-        ],
-        "capabilities": [
-            "CAPABILITY_NAMED_IAM"
-        ]
-    },
-    "AWS::IAM::ManagedPolicy": {
-        "importProperties": [
-            "PolicyArn"
-        ],
-        "capabilities": [
-            "CAPABILITY_NAMED_IAM"
-        ]
+        summary += ", no retain update"
+    summary += ", {} byte import template ({})".format(plan['ImportTemplateBytes'], plan['ImportTemplate'])
+    if plan['CleanUpChanges']:
+        summary += ", clean up of {} difference(s)".format(plan['CleanUpChanges'])
+    else:
+        summary += ", no clean up"
+    if plan['MigratedExports']:
+        summary += ", migrate {} export(s) imported by {} stack(s)".format(len(plan['MigratedExports']), len(plan['PinnedStacks']))
+    return summary
+
+def listStackResources(cfnclient, stack_id):
+    # describe_stack_resources truncates large stacks, so page through list_stack_resources instead
+    list_args = {
+        'StackName': stack_id
     }
-}
-
-if len(sys.argv) == 5:
-    session = boto3.session.Session(profile_name=sys.argv[4])
-    cfnclient = session.client('cloudformation', region_name=sys.argv[3])
-elif len(sys.argv) == 4:
-    cfnclient = boto3.client('cloudformation', region_name=sys.argv[3])
-elif len(sys.argv) == 3:
-    cfnclient = boto3.client('cloudformation')
-else:
-    print("Inconsistent arguments")
-    quit()
+    while True:
+        list_result = cfnclient.list_stack_resources(**list_args)
+        for resource in list_result['StackResourceSummaries']:
+            yield resource
+        if 'NextToken' not in list_result:
+            return
+        list_args['NextToken'] = list_result['NextToken']
 
-try:
-    stacks = cfnclient.describe_stacks(
-        StackName=sys.argv[1]
-    )['Stacks']
-except:
-    print("Could not find stack")
-    quit()
-
-original_stack_id = stacks[0]['StackId']
-stack_name = stacks[0]['StackName']
-new_stack_name = sys.argv[2]
-stack_params = []
-if 'Parameters' in stacks[0]:
-    stack_params = stacks[0]['Parameters']
-
-original_template = cfnclient.get_template(
-    StackName=original_stack_id,
-    TemplateStage='Processed'
-)['TemplateBody']
-
-original_resources = cfnclient.describe_stack_resources(
-    StackName=original_stack_id
-)['StackResources']
-
-if not isinstance(original_template, str):
-    original_template = json.dumps(dict(original_template)) # OrderedDict
-
-print("Found stack, detecting drift...")
-
-stack_drift_detection_id = cfnclient.detect_stack_drift(
-    StackName=original_stack_id
-)['StackDriftDetectionId']
-
-stack_drift_detection_status = cfnclient.describe_stack_drift_detection_status( # no waiter :(
-    StackDriftDetectionId=stack_drift_detection_id
-)
-while stack_drift_detection_status['DetectionStatus'] == "DETECTION_IN_PROGRESS":
-    time.sleep(5)
-    stack_drift_detection_status = cfnclient.describe_stack_drift_detection_status(
-        StackDriftDetectionId=stack_drift_detection_id
-    )
+def listExports(cfnclient):
+    list_args = {}
+    while True:
+        list_result = cfnclient.list_exports(**list_args)
+        for export in list_result['Exports']:
+            yield export
+        if 'NextToken' not in list_result:
+            return
+        list_args['NextToken'] = list_result['NextToken']
 
-if stack_drift_detection_status['DetectionStatus'] != "DETECTION_COMPLETE" or stack_drift_detection_status['StackDriftStatus'] != "DRIFTED":
-    if stack_drift_detection_status['StackDriftStatus'] != "IN_SYNC":
-        print("Could not determine drift results")
-        quit()
+def listImports(cfnclient, export_name):
+    # stack names importing the export; an unused export is reported as an error
+    imports = []
+    list_args = {
+        'ExportName': export_name
+    }
+    while True:
+        try:
+            list_result = cfnclient.list_imports(**list_args)
+        except ClientError as e:
+            if 'is not imported by any stack' not in str(e):
+                raise
+            return imports
+        imports += list_result['Imports']
+        if 'NextToken' not in list_result:
+            return imports
+        list_args['NextToken'] = list_result['NextToken']
 
-resource_drifts = []
-resource_drifts_result = cfnclient.describe_stack_resource_drifts(
-    StackName=original_stack_id,
-    StackResourceDriftStatusFilters=[
-        'IN_SYNC',
-        'MODIFIED',
-        'DELETED',
-        'NOT_CHECKED'
-    ],
-    MaxResults=100
-)
-resource_drifts += resource_drifts_result['StackResourceDrifts']
-while 'NextToken' in resource_drifts_result:
-    resource_drifts_result = cfnclient.describe_stack_resource_drifts(
-        StackName=original_stack_id,
-        StackResourceDriftStatusFilters=[
+def listResourceDrifts(cfnclient, stack_id):
+    # a page at a time, so callers can keep what they need of each record before the next page arrives
+    list_args = {
+        'StackName': stack_id,
+        'StackResourceDriftStatusFilters': [
             'IN_SYNC',
             'MODIFIED',
             'DELETED',
             'NOT_CHECKED'
         ],
-        NextToken=resource_drifts_result['NextToken'],
-        MaxResults=100
-    )
-    resource_drifts += resource_drifts_result['StackResourceDrifts']
+        'MaxResults': 100 # the most the API returns per page
+    }
+    while True:
+        list_result = cfnclient.describe_stack_resource_drifts(**list_args)
+        for resource_drift in list_result['StackResourceDrifts']:
+            yield resource_drift
+        if 'NextToken' not in list_result:
+            return
+        list_args['NextToken'] = list_result['NextToken']
 
-template = json.loads(to_json(original_template))
+def describeNestedStack(cfnclient, logical_id, stack_id):
+    stack = cfnclient.describe_stacks(
+        StackName=stack_id
+    )['Stacks'][0]
+    return {
+        'LogicalResourceId': logical_id,
+        'StackId': stack['StackId'],
+        'StackName': stack['StackName'],
+        'StackStatus': stack['StackStatus'],
+        'Parameters': stack.get('Parameters', []),
+        'Outputs': stack.get('Outputs', []),
+        'Children': OrderedDict((resource['LogicalResourceId'], resource['PhysicalResourceId']) for resource in listStackResources(cfnclient, stack['StackId'])
+            if resource['ResourceType'] == 'AWS::CloudFormation::Stack' and resource.get('PhysicalResourceId'))
+    }
 
-# check all is in drift results
-for k, v in template['Resources'].items():
-    found = False
-    resource_exists = False
+def describeNestedStacks(cfnclient, child_stacks, concurrency=4):
+    # walks the tree a level at a time with each level's stacks described in parallel, so deep
+    # hierarchies take time proportional to their depth rather than their size
+    nodes = OrderedDict()
+    level = [(nodes, logical_id, stack_id) for logical_id, stack_id in child_stacks.items()]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while level:
+            described = list(executor.map(lambda child: describeNestedStack(cfnclient, child[1], child[2]), level))
+            next_level = []
+            for (siblings, logical_id, _), node in zip(level, described):
+                siblings[logical_id] = node
+                child_stacks = node['Children']
+                node['Children'] = OrderedDict()
+                next_level += [(node['Children'], child_logical_id, child_stack_id) for child_logical_id, child_stack_id in child_stacks.items()]
+            level = next_level
+    return nodes
 
-    for deployed_resource in original_resources:
-        if k == deployed_resource['LogicalResourceId']:
-            resource_exists = True
+def walkNestedStacks(nodes, depth=1):
+    for node in nodes.values():
+        yield node, depth
+        yield from walkNestedStacks(node['Children'], depth + 1)
 
-    if not resource_exists and 'Condition' in template['Resources'][k]: # skip conditionals
-        continue
+def loadEligibleImportResources():
+    global eligible_import_resources
+    if eligible_import_resources is None:
+        with eligible_import_resources_lock:
+            if eligible_import_resources is None:
+                with open(ELIGIBLE_IMPORT_RESOURCES_PATH) as f:
+                    eligible_import_resources = json.load(f)
+    return eligible_import_resources
 
-    for i in range(len(resource_drifts)):
-        if resource_drifts[i]['LogicalResourceId'] == k:
-            found = True
-            break
-    if not found:
-        print("Found resource type without drift info: " + template['Resources'][k]['Type'] + ", aborting")
-        quit()
-    if template['Resources'][k]['Type'] not in eligible_import_resources.keys():
-        print("Found non-importable resource type: " + template['Resources'][k]['Type'] + ", aborting")
-        quit()
+def getImportableType(resource_type):
+    return loadEligibleImportResources().get(resource_type)
 
-for k, v in template['Resources'].items():
-    template['Resources'][k]['DeletionPolicy'] = 'Retain'
-
-print("Setting resource retention...")
-
-cfnclient.update_stack(
-    StackName=original_stack_id,
-    TemplateBody=json.dumps(template),
-    Capabilities=[
-        'CAPABILITY_NAMED_IAM',
-        'CAPABILITY_AUTO_EXPAND'
-    ],
-    Parameters=stack_params
-)
-
-waiter = cfnclient.get_waiter('stack_update_complete')
-waiter.wait(
-    StackName=original_stack_id,
-    WaiterConfig={
-        'Delay': 10,
-        'MaxAttempts': 360
+def describeResourceTypes(cfnclient, concurrency=8, log=print):
+    # one bulk pass over the registry: every public AWS resource type and the parts of its schema import needs
+    type_names = []
+    list_args = {
+        'Visibility': 'PUBLIC',
+        'Type': 'RESOURCE',
+        'Filters': {
+            'Category': 'AWS_TYPES'
+        }
     }
-)
-
-import_resources = []
-for drifted_resource in resource_drifts:
-    resource_identifier = {}
-
-    import_properties = eligible_import_resources[drifted_resource['ResourceType']]['importProperties'].copy()
-    if 'PhysicalResourceIdContext' in drifted_resource:
-        for prop in drifted_resource['PhysicalResourceIdContext']:
-            if prop['Key'] in import_properties:
-                resource_identifier[prop['Key']] = prop['Value']
-                import_properties.remove(prop['Key'])
-    
-    if len(import_properties) > 1:
-        print("ERROR: Unexpected additional importable keys required, aborting...")
-        quit()
-    elif len(import_properties) == 1:
-        resource_identifier[import_properties[0]] = drifted_resource['PhysicalResourceId']
+    while True:
+        list_result = cfnclient.list_types(**list_args)
+        type_names += [type_summary['TypeName'] for type_summary in list_result['TypeSummaries']]
+        if 'NextToken' not in list_result:
+            break
+        list_args['NextToken'] = list_result['NextToken']
+    log("Found {} resource types, reading schemas...".format(len(type_names)))
 
-    template['Resources'][drifted_resource['LogicalResourceId']] = {
-        'DeletionPolicy': 'Retain',
-        'Type': drifted_resource['ResourceType'],
-        'Properties': json.loads(drifted_resource['ActualProperties'])
+    def describeSchema(type_name):
+        schema = json.loads(cfnclient.describe_type(
+            Type='RESOURCE',
+            TypeName=type_name
+        )['Schema'])
+        return {
+            'primaryIdentifier': schema.get('primaryIdentifier', []),
+            'handlers': sorted(schema.get('handlers', {}).keys())
+        }
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return dict(zip(type_names, executor.map(describeSchema, type_names)))
+
+def importableTypeFromSchema(schema):
+    # import needs to be able to look the resource up by its identifier
+    if not schema['primaryIdentifier'] or 'read' not in schema['handlers']:
+        return None
+    return {
+        'importProperties': [identifier.split('/')[-1] for identifier in schema['primaryIdentifier']]
     }
 
-    import_resources.append({
-        'ResourceType': drifted_resource['ResourceType'],
-        'LogicalResourceId': drifted_resource['LogicalResourceId'],
-        'ResourceIdentifier': resource_identifier
-    })
+def regenerateImportTable(cfnclient, path=ELIGIBLE_IMPORT_RESOURCES_PATH, concurrency=8, log=print):
+    # rebuild the table from the registry schemas' primaryIdentifier, keeping known capabilities
+    existing = loadEligibleImportResources()
+    schemas = describeResourceTypes(cfnclient, concurrency, log)
 
-print("Removing original stack (whilst retaining resources!)...")
+    table = OrderedDict()
+    for type_name in sorted(schemas.keys()):
+        importable_type = importableTypeFromSchema(schemas[type_name])
+        if importable_type is None:
+            continue
+        table[type_name] = importable_type
+        if type_name in existing and 'capabilities' in existing[type_name]:
+            table[type_name]['capabilities'] = existing[type_name]['capabilities']
 
-cfnclient.delete_stack(
-    StackName=original_stack_id
-)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(table, f, indent=4)
+        f.write('\n')
+    os.replace(path + '.tmp', path)
 
-waiter = cfnclient.get_waiter('stack_delete_complete')
-waiter.wait(
-    StackName=original_stack_id,
-    WaiterConfig={
-        'Delay': 10,
-        'MaxAttempts': 360
-    }
-)
-
-print("Recreating stack with imported resources...")
-
-template.pop('Outputs', None)
-
-change_set_name = 'Stack-Rename-' + str(int(time.time()))
-new_stack_id = cfnclient.create_change_set(
-    StackName=new_stack_name,
-    ChangeSetName=change_set_name,
-    TemplateBody=json.dumps(template),
-    ChangeSetType='IMPORT',
-    Capabilities=[
-        'CAPABILITY_NAMED_IAM',
-        'CAPABILITY_AUTO_EXPAND'
-    ],
-    ResourcesToImport=import_resources,
-    Parameters=stack_params
-)['StackId']
-
-waiter = cfnclient.get_waiter('change_set_create_complete')
-waiter.wait(
-    StackName=new_stack_id,
-    ChangeSetName=change_set_name,
-    WaiterConfig={
-        'Delay': 10,
-        'MaxAttempts': 360
+    global eligible_import_resources
+    eligible_import_resources = table
+    log("Wrote {} importable resource types to {}".format(len(table), path))
+    return table
+
+class SchemaCache:
+    """Local cache of registry schemas for resource types missing from eligible_import_resources.json.
+
+    All public resource types for a region are described in one bulk pass on the first lookup that
+    misses the table, then reused from disk by later runs until the cache is older than ttl seconds.
+    """
+
+    VERSION = 1
+
+    def __init__(self, cfnclient, directory, ttl=86400, concurrency=8, log=print):
+        self.cfnclient = cfnclient
+        self.directory = directory
+        self.ttl = ttl
+        self.concurrency = concurrency
+        self.log = log
+        self.region = cfnclient.meta.region_name
+        self.schemas = None
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self):
+        return os.path.join(self.directory, 'schemas-' + str(self.region) + '.json')
+
+    def load(self):
+        with self.lock:
+            if self.schemas is None:
+                try:
+                    with open(self.path()) as f:
+                        cached = json.load(f)
+                    if cached['Version'] == self.VERSION and time.time() - cached['Created'] <= self.ttl:
+                        self.schemas = cached['Types']
+                except (OSError, ValueError, KeyError):
+                    pass
+            if self.schemas is None:
+                self.log("Refreshing resource type schema cache for " + str(self.region) + "...")
+                self.schemas = describeResourceTypes(self.cfnclient, self.concurrency, self.log)
+                tmp_path = self.path() + '.' + str(threading.get_ident()) + '.tmp' # caches of other profiles share the file
+                with open(tmp_path, 'w') as f:
+                    json.dump({
+                        'Version': self.VERSION,
+                        'Region': self.region,
+                        'Created': time.time(),
+                        'Types': self.schemas
+                    }, f)
+                os.replace(tmp_path, self.path())
+        return self.schemas
+
+    def getImportableType(self, resource_type):
+        schema = self.load().get(resource_type)
+        if schema is None:
+            return None
+        return importableTypeFromSchema(schema)
+
+class ExportIndex:
+    """Short-lived cache of every export in a region, shared by the renames in a batch.
+
+    list_exports pages through the whole account's exports, so one listing serves every stack checked
+    within ttl seconds of it. Imports of those exports change more often and are never cached.
+    """
+
+    def __init__(self, ttl=60, concurrency=8):
+        self.ttl = ttl
+        self.concurrency = concurrency
+        self.exports = None
+        self.listed = 0
+        self.lock = threading.Lock()
+
+    def exportsOf(self, cfnclient, stack_id):
+        with self.lock: # concurrent renames wait on one listing rather than each making their own
+            if self.exports is None or time.time() - self.listed > self.ttl:
+                self.exports = list(listExports(cfnclient))
+                self.listed = time.time()
+            return [export for export in self.exports if export['ExportingStackId'] == stack_id]
+
+    def importingStacks(self, cfnclient, export_names):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return dict(zip(export_names, executor.map(lambda export_name: listImports(cfnclient, export_name), export_names)))
+
+class RenameJournal:
+    """Write-ahead journal of a rename's progress, so an interrupted rename can be resumed.
+
+    Each record is one JSON line, flushed and fsync'd before the rename moves on. A record torn by a
+    crash fails to parse and is cut off by load(), along with anything after it, so a resumed run
+    appends after the last intact record. A run that isn't resuming starts a new journal.
+    """
+
+    VERSION = 1
+
+    def __init__(self, directory, stack_name, new_stack_name):
+        os.makedirs(directory, exist_ok=True)
+        safe_name = re.sub(r'[^A-Za-z0-9-]', '_', stack_name) + '--' + re.sub(r'[^A-Za-z0-9-]', '_', new_stack_name)
+        self.path = os.path.join(directory, safe_name + '.journal')
+
+    def start(self):
+        # keep the previous run's journal aside rather than resuming from it by mistake
+        if os.path.exists(self.path):
+            os.replace(self.path, self.path + '.previous')
+
+    def append(self, phase, status, state=None):
+        record = json.dumps({
+            'Version': self.VERSION,
+            'Phase': phase,
+            'Status': status,
+            'Time': time.time(),
+            'State': state
+        }, default=str)
+        with open(self.path, 'a') as f:
+            f.write(record + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load(self):
+        records = []
+        intact = True
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        intact = False
+                        break
+                    if record.get('Version') != self.VERSION:
+                        raise RenameError("Journal " + self.path + " was written by an incompatible version")
+                    records.append(record)
+                    if not line.endswith('\n'): # a record torn just before its newline
+                        intact = False
+        except FileNotFoundError:
+            pass
+        if not intact:
+            self.rewrite(records)
+        return records
+
+    def rewrite(self, records):
+        with open(self.path + '.tmp', 'w') as f:
+            for record in records:
+                f.write(json.dumps(record, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + '.tmp', self.path)
+
+def advancePhase(steps, result):
+    # resume a phase generator with the result of its last wait; returns (done, next wait request)
+    try:
+        return (False, steps.send(result))
+    except StopIteration:
+        return (True, None)
+
+def createClient(region=None, profile=None, service='cloudformation', max_pool_connections=None):
+    session = boto3.session.Session(profile_name=profile)
+    config = Config(max_pool_connections=max_pool_connections) if max_pool_connections else None
+    return session.client(service, region_name=region, config=config)
+
+class StackRenamer:
+    """Renames one stack by retaining its resources, deleting it and importing them into a new stack.
+
+    The CloudFormation client is passed in so a long-running process can share one client (and its
+    connection pool) across many renames. run() performs every phase in order; runPhase() runs a single
+    phase, in the order listed in PHASES.
+
+    Phases that wait on CloudFormation are generators: they yield a (phase, poll) wait request and are
+    sent the result once it settles. That keeps the waiting out of the phase itself, so run() can block
+    on it while runAsync() awaits it on an event loop without holding a thread.
+
+    Nested stacks are carried over whole: the parent retains them like any other resource, so each
+    child stays deployed with its own resources and descendants, and is imported into the new parent
+    by its stack ID.
+
+    With migrate_exports, stacks importing this stack's exports have their Fn::ImportValue swapped for
+    the exported values before the original stack is deleted, then put back once the new stack
+    exports them again. Their resources see the same values throughout, so nothing downstream changes.
+    """
+
+    PHASES = ['discover', 'detectDrift', 'checkExports', 'retain', 'buildImport', 'pinImports', 'delete', 'importResources', 'restore', 'unpinImports']
+
+    # the phases run instead with plan_only, none of which change the stack
+    PLAN_PHASES = ['discover', 'detectDrift', 'checkExports', 'plan']
+
+    # everything small a later phase needs from an earlier one, saved to the journal in every record
+    JOURNAL_STATE = ['original_stack_id', 'new_stack_id', 'change_set_name', 'stack_params', 'imported_exports', 'pinned_imports']
+
+    # the large state, saved only when the phase producing it completes; a resumed run merges the records
+    JOURNAL_PHASE_STATE = {
+        'detectDrift': ['original_template', 'template', 'resource_drifts', 'nested_stacks'],
+        'buildImport': ['template', 'import_resources']
     }
-)
-
-cfnclient.execute_change_set(
-    ChangeSetName=change_set_name,
-    StackName=new_stack_id
-)
-
-waiter = cfnclient.get_waiter('stack_import_complete')
-waiter.wait(
-    StackName=new_stack_id,
-    WaiterConfig={
-        'Delay': 10,
-        'MaxAttempts': 360
+
+    NESTED_STACK_TYPE = 'AWS::CloudFormation::Stack'
+
+    # the parts of each drift record the rename uses
+    DRIFT_FIELDS = ['LogicalResourceId', 'ResourceType', 'PhysicalResourceId', 'PhysicalResourceIdContext', 'StackResourceDriftStatus', 'ActualProperties', 'ActualPropertiesKey']
+
+    def __init__(self, cfnclient, stack_name, new_stack_name, log=print, wait_engine=None, drift_max_age=0, drift_cache_dir=None, template_stager=None, schema_cache=None, journal_dir=None, resume=False, keep_retain_policy=False, nested_concurrency=4, plan_only=False, export_index=None, migrate_exports=False, property_store=None):
+        self.stack_name = stack_name
+        self.new_stack_name = new_stack_name
+        self.log = log
+        self.drift_max_age = drift_max_age
+        self.drift_cache = DriftCache(drift_cache_dir) if drift_cache_dir else None
+        self.template_stager = template_stager
+        self.schema_cache = schema_cache
+        self.plan_only = plan_only
+        self.export_index = export_index if export_index is not None else ExportIndex()
+        self.migrate_exports = migrate_exports
+        self.property_store = property_store
+        self.journal = RenameJournal(journal_dir, stack_name, new_stack_name) if journal_dir and not plan_only else None
+        self.resume = resume
+        self.keep_retain_policy = keep_retain_policy
+        self.nested_concurrency = nested_concurrency
+        self.wait_engine = wait_engine if wait_engine is not None else WaitEngine(log=log)
+        self.recorder = RunRecorder(stack_name, new_stack_name, self.wait_engine)
+        self.cfnclient = InstrumentedClient(cfnclient, self.recorder)
+
+        self.stack = None
+        self.original_stack_id = None
+        self.new_stack_id = None
+        self.stack_params = []
+        self.original_template = None
+        self.original_resources = {} # by LogicalResourceId, filled lazily from original_resource_pages
+        self.original_resource_pages = None
+        self.resource_drifts = {} # by LogicalResourceId
+        self.template = None
+        self.import_resources = []
+        self.nested_stacks = {} # by LogicalResourceId, each with its own nested stacks under Children
+        self.resolver = None
+        self.imported_exports = {} # by export name, the value and importing stack names
+        self.pinned_imports = [] # importing stacks with their original templates, while pinned
+        self.change_set_name = None
+        self.completed_phases = []
+        self.interrupted_phase = None
+
+    def run(self):
+        self.recorder.start()
+        try:
+            for phase in self.pendingPhases():
+                with self.recorder.phase(phase):
+                    self.journalPhase(phase, 'STARTED')
+                    self.runPhase(phase)
+                    self.journalPhase(phase, 'COMPLETED')
+            self.releaseProperties()
+        except Exception as e:
+            self.recorder.finish(self.new_stack_id, e)
+            raise
+        self.recorder.finish(self.new_stack_id)
+        return self.new_stack_id
+
+    def runPhase(self, phase):
+        steps = self.phaseSteps(phase)
+        if steps is None:
+            return
+        done, wait = advancePhase(steps, None)
+        while not done:
+            done, wait = advancePhase(steps, self.wait_engine.wait(*wait))
+
+    async def runAsync(self, executor=None):
+        # the same phases as run(), but API calls run in executor and waits sleep on the event loop
+        loop = asyncio.get_running_loop()
+        self.recorder.start()
+        try:
+            for phase in await loop.run_in_executor(executor, self.pendingPhases):
+                with self.recorder.phase(phase):
+                    await loop.run_in_executor(executor, self.journalPhase, phase, 'STARTED')
+                    steps = await loop.run_in_executor(executor, self.phaseSteps, phase)
+                    if steps is not None:
+                        done, wait = await loop.run_in_executor(executor, advancePhase, steps, None)
+                        while not done:
+                            result = await self.wait_engine.waitAsync(wait[0], wait[1], executor)
+                            done, wait = await loop.run_in_executor(executor, advancePhase, steps, result)
+                    await loop.run_in_executor(executor, self.journalPhase, phase, 'COMPLETED')
+            await loop.run_in_executor(executor, self.releaseProperties)
+        except Exception as e:
+            self.recorder.finish(self.new_stack_id, e)
+            raise
+        self.recorder.finish(self.new_stack_id)
+        return self.new_stack_id
+
+    def releaseProperties(self):
+        # spilled blobs are kept after a failure, for --resume, and after a plan while the drift cache may reuse them
+        if self.property_store is None or (self.plan_only and self.drift_cache is not None):
+            return
+        self.property_store.release([resource_drift['ActualPropertiesKey'] for resource_drift in self.resource_drifts.values() if 'ActualPropertiesKey' in resource_drift])
+
+    def phaseSteps(self, phase):
+        if phase == self.interrupted_phase:
+            return self.resumePhase(phase)
+        return getattr(self, phase)()
+
+    def resumePhase(self, phase):
+        # a crash mid-phase may have left a stack operation running; let it settle before retrying
+        stack_id = self.new_stack_id or self.original_stack_id
+        if stack_id is not None:
+            self.log("Resuming " + phase + ", waiting for the stack to settle...")
+            yield self.wait_engine.settleWait(self.cfnclient, 'Resume', stack_id)
+        for pinned_import in self.pinned_imports: # so were pin and unpin updates of importing stacks
+            yield self.wait_engine.settleWait(self.cfnclient, 'Resume ' + pinned_import['StackName'], pinned_import['StackId'])
+        steps = getattr(self, phase)()
+        if steps is not None:
+            yield from steps
+
+    def pendingPhases(self):
+        if self.plan_only:
+            return list(self.PLAN_PHASES)
+        if self.journal is not None:
+            if self.resume:
+                self.restoreFromJournal()
+            else:
+                self.journal.start()
+        return [phase for phase in self.PHASES if phase not in self.completed_phases]
+
+    def journalPhase(self, phase, status):
+        if status == 'COMPLETED':
+            self.completed_phases.append(phase)
+            if phase == self.interrupted_phase:
+                self.interrupted_phase = None
+        if self.journal is not None:
+            self.journal.append(phase, status, self.journalState(self.JOURNAL_PHASE_STATE.get(phase, [])) if status == 'COMPLETED' else None)
+
+    def checkpoint(self, phase):
+        # mid-phase record, for phases with a side effect a resumed run must not repeat
+        if self.journal is not None:
+            self.journal.append(phase, 'CHECKPOINT', self.journalState())
+
+    def journalState(self, phase_state=[]):
+        state = {}
+        for attribute in self.JOURNAL_STATE + phase_state:
+            state[attribute] = getattr(self, attribute)
+        if 'resource_drifts' in state:
+            state['resource_drifts'] = list(self.resource_drifts.values())
+        state['completed_phases'] = self.completed_phases
+        return state
+
+    def restoreFromJournal(self):
+        records = self.journal.load()
+        state = {}
+        for record in records:
+            if record['State'] is not None:
+                state.update(record['State'])
+        if 'resource_drifts' not in state:
+            # nothing before drift results changes a stack, so there is nothing to carry on from
+            self.log("No journal to resume from, starting from the beginning")
+            return
+        for attribute in self.JOURNAL_STATE + self.JOURNAL_PHASE_STATE['detectDrift'] + self.JOURNAL_PHASE_STATE['buildImport']:
+            if attribute != 'resource_drifts':
+                setattr(self, attribute, state.get(attribute, getattr(self, attribute))) # journals from older versions lack newer attributes
+        self.resource_drifts = {}
+        self.indexResourceDrifts(state['resource_drifts'])
+        self.completed_phases = list(state['completed_phases'])
+        if records[-1]['Status'] != 'COMPLETED':
+            self.interrupted_phase = records[-1]['Phase']
+        if 'retain' in self.completed_phases and 'buildImport' not in self.completed_phases:
+            self.retainTemplate() # the retained template isn't journaled, it's the drift record's with every policy set
+        if self.original_stack_id is not None and 'delete' not in self.completed_phases: # phases before delete read the description
+            self.stack = self.cfnclient.describe_stacks(
+                StackName=self.original_stack_id
+            )['Stacks'][0]
+            # isDeployed() decides which conditional resources retain and validate cover
+            self.original_resources = {}
+            self.original_resource_pages = listStackResources(self.cfnclient, self.original_stack_id)
+        self.log("Resuming after " + (self.completed_phases[-1] if self.completed_phases else 'start'))
+
+    def discover(self):
+        try:
+            stacks = self.cfnclient.describe_stacks(
+                StackName=self.stack_name
+            )['Stacks']
+        except:
+            raise RenameError("Could not find stack")
+
+        self.stack = stacks[0]
+        self.original_stack_id = stacks[0]['StackId']
+        self.stack_params = []
+        if 'Parameters' in stacks[0]:
+            self.stack_params = stacks[0]['Parameters']
+
+        original_template = self.cfnclient.get_template(
+            StackName=self.original_stack_id,
+            TemplateStage='Processed'
+        )['TemplateBody']
+
+        self.original_resources = {}
+        self.original_resource_pages = listStackResources(self.cfnclient, self.original_stack_id)
+
+        if not isinstance(original_template, str):
+            original_template = serializeTemplate(original_template) # OrderedDict
+        self.original_template = original_template
+        self.template = parseTemplate(original_template)
+
+    def detectDrift(self):
+        drift_information = self.stack.get('DriftInformation', {})
+        last_check = drift_information.get('LastCheckTimestamp')
+        last_updated = self.stack.get('LastUpdatedTime', self.stack.get('CreationTime'))
+
+        if self.isDriftReusable(drift_information, last_updated):
+            age = (datetime.now(timezone.utc) - last_check).total_seconds()
+            self.log("Found stack, reusing drift detection from {:.0f}s ago...".format(age))
+            if self.drift_cache is not None:
+                cached_drifts = self.drift_cache.load(self.original_stack_id, last_updated, last_check)
+                if cached_drifts is not None:
+                    self.resource_drifts = {}
+                    self.indexResourceDrifts(cached_drifts)
+                    self.validate()
+                    return
+        else:
+            self.log("Found stack, detecting drift...")
+
+            stack_drift_detection_id = self.cfnclient.detect_stack_drift(
+                StackName=self.original_stack_id
+            )['StackDriftDetectionId']
+
+            def pollDriftDetection(): # no waiter :(
+                status = self.cfnclient.describe_stack_drift_detection_status(
+                    StackDriftDetectionId=stack_drift_detection_id
+                )
+                if status['DetectionStatus'] == "DETECTION_IN_PROGRESS":
+                    return None
+                return status
+
+            stack_drift_detection_status = yield ('Drift detection', pollDriftDetection)
+
+            if stack_drift_detection_status['DetectionStatus'] != "DETECTION_COMPLETE" or stack_drift_detection_status['StackDriftStatus'] != "DRIFTED":
+                if stack_drift_detection_status['StackDriftStatus'] != "IN_SYNC":
+                    raise RenameError("Could not determine drift results")
+            last_check = stack_drift_detection_status.get('Timestamp')
+
+        self.fetchResourceDrifts()
+        if self.drift_cache is not None and last_check is not None:
+            self.drift_cache.save(self.original_stack_id, last_updated, last_check, list(self.resource_drifts.values()))
+
+        self.validate()
+
+    def isDriftReusable(self, drift_information, last_updated):
+        # drift results describe the stack as of their detection, so an update since then invalidates them
+        last_check = drift_information.get('LastCheckTimestamp')
+        if not self.drift_max_age or last_check is None:
+            return False
+        if drift_information.get('StackDriftStatus') not in ['IN_SYNC', 'DRIFTED']:
+            return False
+        if last_updated is not None and last_updated > last_check:
+            return False
+        return (datetime.now(timezone.utc) - last_check).total_seconds() <= self.drift_max_age
+
+    def fetchResourceDrifts(self):
+        self.resource_drifts = {}
+        self.indexResourceDrifts(listResourceDrifts(self.cfnclient, self.original_stack_id))
+
+    def indexResourceDrifts(self, resource_drifts):
+        # keeps only what the import needs of each record; ExpectedProperties and PropertyDifferences
+        # are often as large as ActualProperties
+        for resource_drift in resource_drifts:
+            kept = {k: resource_drift[k] for k in self.DRIFT_FIELDS if k in resource_drift}
+            if self.property_store is not None and len(kept.get('ActualProperties', '')) > self.property_store.threshold:
+                kept['ActualPropertiesKey'] = self.property_store.put(kept.pop('ActualProperties'))
+            self.resource_drifts[resource_drift['LogicalResourceId']] = kept
+
+    def actualProperties(self, drifted_resource):
+        if 'ActualPropertiesKey' in drifted_resource:
+            if self.property_store is None:
+                raise RenameError("Drift properties of " + drifted_resource['LogicalResourceId'] + " were spilled to disk; pass the same --spill-dir to continue")
+            return json.loads(self.property_store.get(drifted_resource['ActualPropertiesKey']))
+        if 'ActualProperties' in drifted_resource:
+            return json.loads(drifted_resource['ActualProperties'])
+        return None
+
+    def importableType(self, resource_type):
+        importable_type = getImportableType(resource_type)
+        if importable_type is None and self.schema_cache is not None:
+            importable_type = self.schema_cache.getImportableType(resource_type)
+        return importable_type
+
+    def isDeployed(self, logical_id):
+        if logical_id in self.original_resources:
+            return True
+        if self.original_resource_pages is None:
+            return False
+        for resource in self.original_resource_pages:
+            self.original_resources[resource['LogicalResourceId']] = resource
+            if resource['LogicalResourceId'] == logical_id:
+                return True
+        self.original_resource_pages = None
+        return False
+
+    def validate(self):
+        self.discoverNestedStacks()
+
+        # check all is in drift results
+        for k, v in self.template['Resources'].items():
+            if 'Condition' in v and not self.isDeployed(k): # skip conditionals
+                continue
+
+            if v['Type'] == self.NESTED_STACK_TYPE and k in self.nested_stacks:
+                continue
+            if k not in self.resource_drifts:
+                raise RenameError("Found resource type without drift info: " + v['Type'] + ", aborting")
+            if self.importableType(v['Type']) is None:
+                raise RenameError("Found non-importable resource type: " + v['Type'] + ", aborting")
+            if self.resource_drifts[k].get('StackResourceDriftStatus') == 'DELETED':
+                raise RenameError("Found resource deleted outside of CloudFormation: " + k + ", aborting")
+            if 'ActualProperties' not in self.resource_drifts[k] and 'ActualPropertiesKey' not in self.resource_drifts[k]:
+                raise RenameError("Found resource without actual properties in its drift info: " + k + " (" + v['Type'] + "), aborting")
+            self.resourceIdentifier(self.resource_drifts[k]) # fail on unbuildable identifiers before anything is changed
+
+    def discoverNestedStacks(self):
+        child_stacks = OrderedDict()
+        for k, v in self.template['Resources'].items():
+            if v['Type'] != self.NESTED_STACK_TYPE:
+                continue
+            if k in self.resource_drifts and self.resource_drifts[k].get('PhysicalResourceId'):
+                child_stacks[k] = self.resource_drifts[k]['PhysicalResourceId']
+            elif self.isDeployed(k) and self.original_resources[k].get('PhysicalResourceId'):
+                child_stacks[k] = self.original_resources[k]['PhysicalResourceId']
+
+        self.nested_stacks = {}
+        if not child_stacks:
+            return
+        self.nested_stacks = describeNestedStacks(self.cfnclient, child_stacks, self.nested_concurrency)
+
+        # a nested stack mid-operation can't be carried over, wherever it sits in the tree
+        nested_stacks = list(walkNestedStacks(self.nested_stacks))
+        for node, depth in nested_stacks:
+            if node['StackStatus'].endswith('_IN_PROGRESS') or node['StackStatus'].endswith('_FAILED') or node['StackStatus'] == 'ROLLBACK_COMPLETE':
+                raise RenameError("Nested stack " + node['StackName'] + " is in state " + node['StackStatus'] + ", aborting")
+        self.log("Found {} nested stack(s), {} level(s) deep".format(len(nested_stacks), max(depth for node, depth in nested_stacks)))
+
+    def nestedStackProperties(self, logical_id):
+        # nested stacks get no drift results of their own, so take the properties from the template,
+        # pinning parameters computed from other resources to the values the child was given
+        properties = copy.deepcopy(self.template['Resources'][logical_id].get('Properties', {}))
+        actual_parameters = {}
+        for parameter in self.nested_stacks[logical_id]['Parameters']:
+            actual_parameters[parameter['ParameterKey']] = parameter.get('ResolvedValue', parameter['ParameterValue'])
+        for key, value in properties.get('Parameters', {}).items():
+            if isinstance(value, str) or actual_parameters.get(key, '****') == '****': # NoEcho values come back masked
+                continue
+            if self.resolver.resolvePropertyValue(value) != actual_parameters[key]:
+                properties['Parameters'][key] = actual_parameters[key]
+        return properties
+
+    def intrinsicResolver(self):
+        # what references will resolve to in the new stack; its name and ID change, so those are left out
+        refs = parameterRefs(self.original_stack_id, self.template, self.stack_params)
+        for drifted_resource in self.resource_drifts.values():
+            if drifted_resource.get('PhysicalResourceId'):
+                refs[drifted_resource['LogicalResourceId']] = drifted_resource['PhysicalResourceId']
+        attributes = {}
+        for logical_id, node in self.nested_stacks.items(): # the only attributes known without further calls
+            refs[logical_id] = node['StackId']
+            for output in node.get('Outputs', []): # journals from older versions lack them
+                attributes[(logical_id, 'Outputs.' + output['OutputKey'])] = output['OutputValue']
+        return IntrinsicResolver(refs, attributes)
+
+    def checkExports(self):
+        # a stack can't be deleted while another stack imports one of its exports, so find out before retaining
+        exports = self.export_index.exportsOf(self.cfnclient, self.original_stack_id)
+        if not exports:
+            return
+        importing_stacks = self.export_index.importingStacks(self.cfnclient, [export['Name'] for export in exports])
+        imported = OrderedDict((export_name, stack_names) for export_name, stack_names in importing_stacks.items() if stack_names)
+        self.log("Found {} export(s), {} imported by other stacks".format(len(exports), len(imported)))
+        self.imported_exports = OrderedDict()
+        for export in exports:
+            if export['Name'] in imported:
+                self.imported_exports[export['Name']] = {
+                    'Value': export['Value'],
+                    'ImportingStacks': imported[export['Name']]
+                }
+        if imported and not self.migrate_exports:
+            raise RenameError("Found exports imported by other stacks, which would block deleting the stack: " + '; '.join(
+                export_name + ' (' + ', '.join(stack_names) + ')' for export_name, stack_names in imported.items()
+            ) + "; pass --migrate-exports to carry them over, aborting")
+        if imported and self.journal is None and not self.plan_only:
+            raise RenameError("Migrating exports needs --journal-dir, which keeps the importing stacks' original templates should the rename fail, aborting")
+
+        # importing stacks are pointed back at the same names, so the new stack must still export them
+        renamed_exports = [export_name for export_name in imported if export_name not in self.renamedExportNames()]
+        if renamed_exports:
+            raise RenameError("Found imported exports whose names would change or can't be resolved under the new stack name: " + ', '.join(renamed_exports) + "; their importing stacks couldn't be switched back to Fn::ImportValue, aborting")
+
+    def renamedExportNames(self):
+        # export names as the new stack will declare them, e.g. those built from AWS::StackName change
+        resolver = self.intrinsicResolver()
+        resolver.refs['AWS::StackName'] = self.new_stack_name
+        export_names = set()
+        for output in self.template.get('Outputs', {}).values():
+            export_name = resolver.resolvePropertyValue(output.get('Export', {}).get('Name'))
+            if isinstance(export_name, str):
+                export_names.add(export_name)
+        return export_names
+
+    def importingStacks(self):
+        stack_names = []
+        for imported_export in self.imported_exports.values():
+            stack_names += [stack_name for stack_name in imported_export['ImportingStacks'] if stack_name not in stack_names]
+        return stack_names
+
+    def pinnedTemplate(self, stack_name):
+        # the importing stack's template with this stack's imported exports pinned to their values
+        stack = self.cfnclient.describe_stacks(
+            StackName=stack_name
+        )['Stacks'][0]
+        template_body = self.cfnclient.get_template(
+            StackName=stack['StackId'],
+            TemplateStage='Original'
+        )['TemplateBody']
+        if not isinstance(template_body, str):
+            template_body = serializeTemplate(template_body) # OrderedDict
+        template = parseTemplate(template_body)
+
+        export_values = OrderedDict((export_name, imported_export['Value']) for export_name, imported_export in self.imported_exports.items() if stack_name in imported_export['ImportingStacks'])
+        resolver = IntrinsicResolver(parameterRefs(stack['StackId'], template, stack.get('Parameters', [])))
+        pinned_template, pinned = pinImportValues(template, export_values, resolver)
+        if len(pinned) != len(export_values):
+            raise RenameError("Could not find the Fn::ImportValue of " + ', '.join(export_name for export_name in export_values if export_name not in pinned) + " in " + stack_name + "'s template, aborting")
+        return {
+            'StackName': stack_name,
+            'StackId': stack['StackId'],
+            'Parameters': [{'ParameterKey': parameter['ParameterKey'], 'UsePreviousValue': True} for parameter in stack.get('Parameters', [])],
+            'OriginalTemplate': template_body,
+            'PinnedTemplate': serializeTemplate(pinned_template)
+        }
+
+    def pinImports(self):
+        already_pinned = [pinned_import['StackName'] for pinned_import in self.pinned_imports] # by a resumed run
+        stack_names = [stack_name for stack_name in self.importingStacks() if stack_name not in already_pinned]
+        if not stack_names and not already_pinned:
+            return
+        pinned_imports = [self.pinnedTemplate(stack_name) for stack_name in stack_names] # all built before any is changed
+        self.log("Pinning {} export(s) to their values in {} importing stack(s)...".format(len(self.imported_exports), len(already_pinned) + len(pinned_imports)))
+
+        # start every update before waiting on any, so the importing stacks update in parallel
+        waits = []
+        for pinned_import in self.pinned_imports: # again, in case the update the journal records didn't complete
+            wait = self.updateStack('Pin imports of ' + pinned_import['StackName'], pinned_import['StackId'], pinned_import['PinnedTemplate'], pinned_import['Parameters'])
+            if wait is not None:
+                waits.append(wait)
+        for pinned_import in pinned_imports:
+            self.pinned_imports.append(pinned_import)
+            self.checkpoint('pinImports') # the original template must survive a crash mid-update
+            wait = self.updateStack('Pin imports of ' + pinned_import['StackName'], pinned_import['StackId'], pinned_import['PinnedTemplate'], pinned_import['Parameters'])
+            if wait is not None:
+                waits.append(wait)
+        for wait in waits:
+            yield wait
+
+    def unpinImports(self):
+        if not self.pinned_imports:
+            return
+        self.log("Restoring Fn::ImportValue in {} importing stack(s)...".format(len(self.pinned_imports)))
+
+        waits = []
+        for pinned_import in self.pinned_imports:
+            wait = self.updateStack('Unpin imports of ' + pinned_import['StackName'], pinned_import['StackId'], pinned_import['OriginalTemplate'], pinned_import['Parameters'])
+            if wait is not None:
+                waits.append(wait)
+        for wait in waits:
+            yield wait
+        self.pinned_imports = []
+
+    def unretainedResources(self):
+        # only deployed resources need the policy change, and many stacks already retain everything
+        return [k for k, v in self.template['Resources'].items() if v.get('DeletionPolicy') != 'Retain' and ('Condition' not in v or self.isDeployed(k))]
+
+    def retainTemplate(self):
+        for v in self.template['Resources'].values():
+            v['DeletionPolicy'] = 'Retain'
+
+    def retain(self):
+        unretained = self.unretainedResources()
+        self.retainTemplate()
+
+        if not unretained:
+            self.log("All resources are already retained, skipping retention update")
+            return
+
+        self.log("Setting resource retention on {} of {} resources...".format(len(unretained), len(self.template['Resources'])))
+
+        wait = self.updateStack('Retain update', self.original_stack_id, serializeTemplate(self.template))
+        if wait is not None:
+            yield wait
+
+    def buildImport(self):
+        self.import_resources = []
+        self.resolver = self.intrinsicResolver()
+        for logical_id, node in self.nested_stacks.items():
+            self.template['Resources'][logical_id] = {
+                'DeletionPolicy': 'Retain',
+                'Type': self.NESTED_STACK_TYPE,
+                'Properties': self.nestedStackProperties(logical_id)
+            }
+            self.import_resources.append({
+                'ResourceType': self.NESTED_STACK_TYPE,
+                'LogicalResourceId': logical_id,
+                'ResourceIdentifier': {
+                    'StackId': node['StackId']
+                }
+            })
+
+        for drifted_resource in self.resource_drifts.values():
+            if drifted_resource['LogicalResourceId'] in self.nested_stacks:
+                continue
+            actual_properties = self.actualProperties(drifted_resource)
+            resource_identifier = self.resourceIdentifier(drifted_resource, actual_properties)
+
+            # literal values stand in for the template's references, except where those resolve to them exactly
+            template_properties = self.template['Resources'][drifted_resource['LogicalResourceId']].get('Properties', {})
+            self.template['Resources'][drifted_resource['LogicalResourceId']] = {
+                'DeletionPolicy': 'Retain',
+                'Type': drifted_resource['ResourceType'],
+                'Properties': self.resolver.referenceActualProperties(
+                    pruneActualProperties(actual_properties, template_properties),
+                    template_properties
+                )
+            }
+
+            self.import_resources.append({
+                'ResourceType': drifted_resource['ResourceType'],
+                'LogicalResourceId': drifted_resource['LogicalResourceId'],
+                'ResourceIdentifier': resource_identifier
+            })
+
+        self.template.pop('Outputs', None) # re-attached by the clean up update, once the import has succeeded
+
+    def resourceIdentifier(self, drifted_resource, actual_properties=None):
+        resource_identifier = {}
+
+        import_properties = self.importableType(drifted_resource['ResourceType'])['importProperties'].copy()
+        if 'PhysicalResourceIdContext' in drifted_resource:
+            for prop in drifted_resource['PhysicalResourceIdContext']:
+                if prop['Key'] in import_properties:
+                    resource_identifier[prop['Key']] = prop['Value']
+                    import_properties.remove(prop['Key'])
+
+        if len(import_properties) > 1: # compound identifier, the other parts are usually plain properties
+            if actual_properties is None:
+                actual_properties = self.actualProperties(drifted_resource) or {}
+            for prop in list(import_properties):
+                if isinstance(actual_properties.get(prop), str):
+                    resource_identifier[prop] = actual_properties[prop]
+                    import_properties.remove(prop)
+
+        if len(import_properties) > 1:
+            physical_id_parts = drifted_resource['PhysicalResourceId'].split('|')
+            if len(physical_id_parts) != len(import_properties):
+                raise RenameError("Could not build the import identifier of " + drifted_resource['LogicalResourceId'] + " (" + ', '.join(import_properties) + "), aborting")
+            resource_identifier.update(zip(import_properties, physical_id_parts))
+        elif len(import_properties) == 1:
+            resource_identifier[import_properties[0]] = drifted_resource['PhysicalResourceId']
+
+        return resource_identifier
+
+    def templateArgs(self, template_body):
+        template_size = len(template_body.encode('utf-8'))
+        self.recorder.recordTemplate(template_size)
+        if self.templateDelivery(template_size) == 'S3':
+            return self.template_stager.templateArgs(template_body)
+        return {
+            'TemplateBody': template_body
+        }
+
+    def templateDelivery(self, template_size):
+        if template_size > TemplateStager.MAX_TEMPLATE_URL_SIZE:
+            raise RenameError("Template is {} bytes, over the {} byte limit for CloudFormation templates".format(
+                template_size,
+                TemplateStager.MAX_TEMPLATE_URL_SIZE
+            ))
+        if template_size <= TemplateStager.MAX_TEMPLATE_BODY_SIZE:
+            return 'inline'
+        if self.template_stager is None:
+            raise RenameError("Template is {} bytes, over the {} byte limit for inline templates; pass --template-bucket to stage it in S3".format(
+                template_size,
+                TemplateStager.MAX_TEMPLATE_BODY_SIZE
+            ))
+        return 'S3'
+
+    def plan(self):
+        # what the remaining phases would do, worked out in memory without changing anything
+        unretained = self.unretainedResources()
+        original_template = parseTemplate(self.original_template)
+        self.retainTemplate()
+        retain_template_size = len(serializeTemplate(self.template).encode('utf-8'))
+        self.buildImport()
+        import_template = self.template
+        import_template_size = len(serializeTemplate(import_template).encode('utf-8'))
+        ignored_attributes = ['DeletionPolicy'] if self.keep_retain_policy else []
+        imported = set(resource['LogicalResourceId'] for resource in self.import_resources)
+        for stack_name in self.importingStacks():
+            self.pinnedTemplate(stack_name) # fails if an importing stack's Fn::ImportValue can't be pinned
+
+        self.recorder.plan = {
+            'Imports': len(self.import_resources),
+            'Skipped': [k for k in self.template['Resources'] if k not in imported],
+            'NestedStacks': len(list(walkNestedStacks(self.nested_stacks))),
+            'RetainUpdate': len(unretained),
+            'RetainTemplate': self.templateDelivery(retain_template_size) if unretained else None,
+            'ImportTemplateBytes': import_template_size,
+            'ImportTemplate': self.templateDelivery(import_template_size),
+            'CleanUpChanges': len(diffTemplates(import_template, original_template, ignored_attributes)),
+            'MigratedExports': list(self.imported_exports.keys()),
+            'PinnedStacks': self.importingStacks(),
+            'ImportResources': self.import_resources
+        }
+        self.log("Plan: " + summarizePlan(self.recorder.plan))
+
+    def delete(self):
+        self.log("Removing original stack (whilst retaining resources!)...")
+
+        self.cfnclient.delete_stack(
+            StackName=self.original_stack_id
+        )
+
+        yield self.wait_engine.stackWait(self.cfnclient, 'Stack deletion', self.original_stack_id, ['DELETE_COMPLETE'], missing_ok=True)
+
+    def importResources(self):
+        self.log("Recreating stack with imported resources...")
+
+        if self.new_stack_id is None: # otherwise a resumed run already created the change set
+            self.change_set_name = 'Stack-Rename-' + str(int(time.time()))
+            self.new_stack_id = self.cfnclient.create_change_set(
+                StackName=self.new_stack_name,
+                ChangeSetName=self.change_set_name,
+                **self.templateArgs(serializeTemplate(self.template)),
+                ChangeSetType='IMPORT',
+                Capabilities=[
+                    'CAPABILITY_NAMED_IAM',
+                    'CAPABILITY_AUTO_EXPAND'
+                ],
+                ResourcesToImport=self.import_resources,
+                Parameters=self.stack_params
+            )['StackId']
+            self.checkpoint('importResources')
+
+        change_set = yield self.wait_engine.changeSetWait(self.cfnclient, 'Import change set creation', self.new_stack_id, self.change_set_name)
+
+        if change_set.get('ExecutionStatus', 'AVAILABLE') == 'AVAILABLE':
+            self.cfnclient.execute_change_set(
+                ChangeSetName=self.change_set_name,
+                StackName=self.new_stack_id
+            )
+
+        yield self.wait_engine.stackWait(self.cfnclient, 'Import', self.new_stack_id, ['IMPORT_COMPLETE'])
+
+    def restore(self):
+        ignored_attributes = ['DeletionPolicy'] if self.keep_retain_policy else []
+        changes = diffTemplates(self.template, parseTemplate(self.original_template), ignored_attributes)
+        if not changes:
+            self.log("Imported template already matches the original, skipping clean up")
+            return
+        self.log("Cleaning up {} template difference(s): {}".format(len(changes), summarizeChanges(changes)))
+
+        original_template = self.original_template
+        if len(original_template.encode('utf-8')) > TemplateStager.MAX_TEMPLATE_BODY_SIZE:
+            original_template = serializeTemplate(parseTemplate(original_template)) # compact JSON may still fit inline
+
+        wait = self.updateStack('Cleanup update', self.new_stack_id, original_template)
+        if wait is not None:
+            yield wait
+
+    def updateStack(self, phase, stack_id, template_body, parameters=None):
+        # returns the wait request for the update, or None if the stack already matches the template
+        try:
+            self.cfnclient.update_stack(
+                StackName=stack_id,
+                **self.templateArgs(template_body),
+                Capabilities=[
+                    'CAPABILITY_NAMED_IAM',
+                    'CAPABILITY_AUTO_EXPAND'
+                ],
+                Parameters=self.stack_params if parameters is None else parameters
+            )
+        except ClientError as e:
+            if 'No updates are to be performed' not in str(e):
+                raise
+            self.log(phase + " not needed, stack already matches")
+            return None
+        return self.wait_engine.stackWait(self.cfnclient, phase, stack_id, ['UPDATE_COMPLETE'])
+
+def readManifest(path):
+    renames = []
+    seen_old = set()
+    seen_new = set()
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            parts = line.replace(',', ' ').split()
+            if len(parts) != 2:
+                raise RenameError("Invalid manifest line: " + line)
+            if parts[0] in seen_old or parts[1] in seen_new:
+                raise RenameError("Duplicate stack in manifest: " + line)
+            seen_old.add(parts[0])
+            seen_new.add(parts[1])
+            renames.append((parts[0], parts[1]))
+    return renames
+
+def jobTarget(job):
+    return '/'.join([part for part in [job['Profile'], job['Region']] if part])
+
+def jobRenamer(job, wait_options):
+    target = jobTarget(job)
+    label = target + ' ' + job['StackName'] if target else job['StackName']
+
+    def log(message):
+        print("[" + label + "] " + message)
+
+    return StackRenamer(job['Client'], job['StackName'], job['NewStackName'], log, WaitEngine(log=log, **wait_options), **job['RenamerOptions'])
+
+def jobReport(job, renamer):
+    report = renamer.recorder.report()
+    report['Profile'] = job['Profile']
+    report['Region'] = job['Region']
+    return report
+
+def runRenames(jobs, concurrency, wait_options={}, region_concurrency=0, use_async=False, executor_threads=16):
+    # each job is a dict of Client, StackName, NewStackName, Profile, Region and RenamerOptions
+    if use_async:
+        reports = asyncio.run(runRenamesAsync(jobs, concurrency, wait_options, region_concurrency, executor_threads))
+        printSummary(reports)
+        return reports
+
+    region_semaphores = {} # by account and region, which is what CloudFormation's quotas apply to
+    if region_concurrency:
+        for job in jobs:
+            region_semaphores.setdefault((job['Profile'], job['Region']), threading.Semaphore(region_concurrency))
+
+    def renameWorker(job):
+        renamer = jobRenamer(job, wait_options)
+        with region_semaphores.get((job['Profile'], job['Region']), nullcontext()):
+            try:
+                renamer.run()
+                renamer.log(("Planned rename to " if renamer.plan_only else "Succcessfully renamed stack to ") + job['NewStackName'])
+            except Exception as e: # one bad stack must not take down the batch
+                renamer.log("Rename failed: " + str(e))
+        return jobReport(job, renamer)
+
+    reports = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = []
+        for job in jobs:
+            futures.append(executor.submit(renameWorker, job))
+        for future in futures:
+            reports.append(future.result())
+
+    printSummary(reports)
+    return reports
+
+async def runRenamesAsync(jobs, concurrency, wait_options={}, region_concurrency=0, executor_threads=16):
+    # every rename is a task on one event loop; only API calls borrow one of executor_threads threads
+    semaphore = asyncio.Semaphore(concurrency)
+    region_semaphores = {} # by account and region, which is what CloudFormation's quotas apply to
+    for job in jobs:
+        region_semaphores.setdefault((job['Profile'], job['Region']), asyncio.Semaphore(region_concurrency or concurrency))
+
+    async def renameTask(job, executor):
+        renamer = jobRenamer(job, wait_options)
+        async with semaphore, region_semaphores[(job['Profile'], job['Region'])]:
+            try:
+                await renamer.runAsync(executor)
+                renamer.log(("Planned rename to " if renamer.plan_only else "Succcessfully renamed stack to ") + job['NewStackName'])
+            except Exception as e: # one bad stack must not take down the batch
+                renamer.log("Rename failed: " + str(e))
+        return jobReport(job, renamer)
+
+    with ThreadPoolExecutor(max_workers=executor_threads) as executor:
+        return await asyncio.gather(*[renameTask(job, executor) for job in jobs])
+
+def printSummary(reports):
+    print("")
+    print("Summary:")
+    for report in reports:
+        target = jobTarget(report)
+        line = "  {}{} -> {}: {} ({:.0f}s)".format(target + ' ' if target else '', report['StackName'], report['NewStackName'], report['Status'], report['Elapsed'])
+        if report['Error']:
+            line += " - " + report['Error']
+        elif report.get('Plan'):
+            line += " - " + summarizePlan(report['Plan'])
+        print(line)
+    failures = len([report for report in reports if report['Status'] != 'SUCCEEDED'])
+    print("{} succeeded, {} failed".format(len(reports) - failures, failures))
+
+def batchRename(cfnclient, renames, concurrency, wait_options={}, renamer_options={}, **run_options):
+    jobs = []
+    for old_stack_name, new_stack_name in renames:
+        jobs.append({
+            'Client': cfnclient,
+            'StackName': old_stack_name,
+            'NewStackName': new_stack_name,
+            'Profile': None,
+            'Region': None,
+            'RenamerOptions': renamer_options
+        })
+    return runRenames(jobs, concurrency, wait_options, **run_options)
+
+def fanOutRename(renames, targets, concurrency, region_concurrency, wait_options={}, renamer_options=None, max_pool_connections=None, **run_options):
+    # targets are (profile, region) pairs; renamer_options(cfnclient, profile, region) builds per-target options
+    clients = OrderedDict()
+    target_options = {}
+    for profile, region in targets: # sessions are not thread safe, so create every client and option up front
+        clients[(profile, region)] = createClient(region, profile, max_pool_connections=max_pool_connections)
+        target_options[(profile, region)] = renamer_options(clients[(profile, region)], profile, region) if renamer_options else {}
+
+    jobs = []
+    for old_stack_name, new_stack_name in renames:
+        for (profile, region), cfnclient in clients.items(): # interleave targets so regions share the pool evenly
+            jobs.append({
+                'Client': cfnclient,
+                'StackName': old_stack_name,
+                'NewStackName': new_stack_name,
+                'Profile': profile,
+                'Region': region,
+                'RenamerOptions': target_options[(profile, region)]
+            })
+    return runRenames(jobs, concurrency, wait_options, region_concurrency, **run_options)
+
+def writeReport(path, report):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=4, default=str)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rename a CloudFormation stack by re-importing its resources into a new stack',
+        usage='%(prog)s OldStackName NewStackName [region [profile]]\n       %(prog)s --manifest FILE [region [profile]]\n       %(prog)s (OldStackName NewStackName | --manifest FILE) --regions REGION [REGION ...] [--profiles PROFILE [PROFILE ...]]\n       %(prog)s --regenerate-import-table [region [profile]]'
+    )
+    parser.add_argument('args', nargs='*', help=argparse.SUPPRESS)
+    parser.add_argument('--manifest', help='file of "OldStackName NewStackName" lines to rename in parallel')
+    parser.add_argument('--regions', nargs='+', help='rename in each of these regions')
+    parser.add_argument('--profiles', nargs='+', help='rename in the account of each of these profiles')
+    parser.add_argument('--regenerate-import-table', action='store_true', help='rebuild eligible_import_resources.json from the CloudFormation registry and exit')
+    parser.add_argument('--concurrency', type=int, default=8, help='maximum number of stacks renamed at once in batch mode (default: 8)')
+    parser.add_argument('--region-concurrency', type=int, default=4, help='maximum number of stacks renamed at once in any one region of one profile with --regions/--profiles (default: 4)')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='run renames as tasks on one asyncio event loop instead of one thread each')
+    parser.add_argument('--executor-threads', type=int, default=16, help='threads making CloudFormation API calls with --async (default: 16)')
+    parser.add_argument('--poll-initial-delay', type=float, default=2, help='seconds before the first status re-check of each phase (default: 2)')
+    parser.add_argument('--poll-max-delay', type=float, default=30, help='upper bound on the delay between status checks (default: 30)')
+    parser.add_argument('--poll-backoff', type=float, default=1.5, help='multiplier applied to the delay after each check (default: 1.5)')
+    parser.add_argument('--poll-timeout', type=float, default=3600, help='seconds to wait for any single phase before giving up (default: 3600)')
+    parser.add_argument('--drift-max-age', type=float, default=0, help='reuse the stack\'s last drift detection if it finished within this many seconds (default: 0, always detect)')
+    parser.add_argument('--drift-cache-dir', help='directory to cache drift results in between runs')
+    parser.add_argument('--spill-dir', help='directory to keep large drift property blobs in instead of memory')
+    parser.add_argument('--spill-threshold', type=int, default=65536, help='size in characters above which drift properties go to --spill-dir (default: 65536)')
+    parser.add_argument('--template-bucket', help='S3 bucket to stage templates over the 51,200 byte inline limit in; may contain {region} and {profile}')
+    parser.add_argument('--template-prefix', default='cfn-stack-rename/', help='key prefix for staged templates (default: cfn-stack-rename/)')
+    parser.add_argument('--schema-cache-dir', help='directory to cache registry schemas in, used to import resource types missing from eligible_import_resources.json')
+    parser.add_argument('--schema-cache-ttl', type=float, default=86400, help='seconds before the schema cache is refreshed (default: 86400)')
+    parser.add_argument('--nested-concurrency', type=int, default=4, help='maximum number of nested stacks described at once while walking a nested stack tree (default: 4)')
+    parser.add_argument('--keep-retain-policy', action='store_true', help='leave DeletionPolicy: Retain on the renamed stack\'s resources, which can save the final clean up update')
+    parser.add_argument('--journal-dir', help='directory to journal each rename\'s progress in, so it can be resumed')
+    parser.add_argument('--resume', action='store_true', help='continue interrupted renames from their journal in --journal-dir')
+    parser.add_argument('--export-index-ttl', type=float, default=60, help='seconds a listing of the region\'s exports is reused for by other renames (default: 60)')
+    parser.add_argument('--migrate-exports', action='store_true', help='pin stacks importing this stack\'s exports to the exported values during the rename, instead of refusing to rename it')
+    parser.add_argument('--plan', action='store_true', help='check each rename and print what it would do, without changing any stack')
+    parser.add_argument('--report', help='write a JSON report of phase timings and API usage to this file')
+    args = parser.parse_args()
+
+    fan_out = args.regions or args.profiles
+    if args.resume and not args.journal_dir:
+        print("--resume requires --journal-dir")
+        quit()
+    positional = args.args
+    if args.manifest or args.regenerate_import_table:
+        positional = [None, None] + positional
+    if len(positional) < 2 or len(positional) > 4 or (fan_out and (len(positional) > 2 or args.regenerate_import_table)):
+        print("Inconsistent arguments")
+        quit()
+    region = positional[2] if len(positional) > 2 else None
+    profile = positional[3] if len(positional) > 3 else None
+
+    run_options = {
+        'use_async': args.use_async,
+        'executor_threads': max(1, args.executor_threads)
     }
-)
-
-print("Cleaning up...")
-
-cfnclient.update_stack(
-    StackName=new_stack_id,
-    TemplateBody=original_template,
-    Capabilities=[
-        'CAPABILITY_NAMED_IAM',
-        'CAPABILITY_AUTO_EXPAND'
-    ],
-    Parameters=stack_params
-)
-
-waiter = cfnclient.get_waiter('stack_update_complete')
-waiter.wait(
-    StackName=new_stack_id,
-    WaiterConfig={
-        'Delay': 10,
-        'MaxAttempts': 360
+    # every concurrent API call needs its own pooled connection
+    max_pool_connections = max(10, args.executor_threads if args.use_async else args.concurrency)
+    wait_options = {
+        'initial_delay': args.poll_initial_delay,
+        'max_delay': args.poll_max_delay,
+        'backoff': args.poll_backoff,
+        'timeout': args.poll_timeout
     }
-)
 
-print("Succcessfully renamed stack")
+    def renamerOptions(cfnclient, profile, region):
+        renamer_options = {
+            'drift_max_age': args.drift_max_age,
+            'drift_cache_dir': args.drift_cache_dir,
+            'journal_dir': os.path.join(args.journal_dir, *[part for part in [profile, region] if part]) if args.journal_dir else None,
+            'resume': args.resume,
+            'keep_retain_policy': args.keep_retain_policy,
+            'nested_concurrency': max(1, args.nested_concurrency),
+            'plan_only': args.plan,
+            'export_index': ExportIndex(args.export_index_ttl, max(1, args.concurrency)),
+            'migrate_exports': args.migrate_exports
+        }
+        if args.spill_dir:
+            renamer_options['property_store'] = PropertyStore(args.spill_dir, args.spill_threshold)
+        if args.schema_cache_dir:
+            renamer_options['schema_cache'] = SchemaCache(cfnclient, args.schema_cache_dir, args.schema_cache_ttl, max(1, args.concurrency))
+        if args.template_bucket:
+            template_bucket = args.template_bucket.replace('{region}', str(region)).replace('{profile}', str(profile))
+            renamer_options['template_stager'] = TemplateStager(createClient(region, profile, 's3'), template_bucket, args.template_prefix)
+        return renamer_options
+
+    renames = [(positional[0], positional[1])]
+    if args.manifest:
+        try:
+            renames = readManifest(args.manifest)
+        except (OSError, RenameError) as e:
+            print(str(e))
+            quit()
+
+    if fan_out:
+        targets = [(target_profile, target_region) for target_profile in (args.profiles or [None]) for target_region in (args.regions or [None])]
+        reports = fanOutRename(renames, targets, max(1, args.concurrency), max(0, args.region_concurrency), wait_options, renamerOptions, max_pool_connections, **run_options)
+        if args.report:
+            writeReport(args.report, {'Renames': reports})
+        if any(report['Status'] != 'SUCCEEDED' for report in reports):
+            sys.exit(1)
+        return
+
+    cfnclient = createClient(region, profile, max_pool_connections=max_pool_connections)
+
+    if args.regenerate_import_table:
+        regenerateImportTable(cfnclient, concurrency=max(1, args.concurrency))
+        return
+
+    renamer_options = renamerOptions(cfnclient, profile, region)
+
+    if args.manifest:
+        reports = batchRename(cfnclient, renames, max(1, args.concurrency), wait_options, renamer_options, **run_options)
+        if args.report:
+            writeReport(args.report, {'Renames': reports})
+        if any(report['Status'] != 'SUCCEEDED' for report in reports):
+            sys.exit(1)
+        return
+
+    renamer = StackRenamer(cfnclient, positional[0], positional[1], wait_engine=WaitEngine(**wait_options), **renamer_options)
+    try:
+        if args.use_async:
+            asyncio.run(renamer.runAsync())
+        else:
+            renamer.run()
+    except RenameError as e:
+        print(str(e))
+        if args.report:
+            writeReport(args.report, renamer.recorder.report())
+        quit()
+
+    if args.report:
+        writeReport(args.report, renamer.recorder.report())
+    if args.plan:
+        print("Rename can go ahead")
+        return
+    print("Succcessfully renamed stack")
+
+if __name__ == "__main__":
+    main()